@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for archived-domain matching. Compares the original substring scan against DomainMatcher
+as the configured domain list grows. DomainMatcher cost should stay flat.
+
+    python benchmarks/domain_matcher.py
+"""
+import sys
+import timeit
+import argparse
+
+from email_archive.domains import DomainMatcher
+
+
+HEADERS = [
+    '"Alice Example" <alice@mail.customer.example>, bob@partner.example',
+    'Carol <carol@unrelated.example>',
+    '"support@domain4999.example" <noreply@vendor.example>',
+    None,
+]
+
+
+def substring_match(headers, domains):
+    """The original archive.check_archived_domain, applied to every header"""
+    for addresses in headers:
+        if addresses is None:
+            continue
+        addresses = addresses.lower()
+        for address in addresses.split(','):
+            for domain in domains:
+                if domain in address:
+                    return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    print('{:>8}  {:>14}  {:>14}'.format('domains', 'substring us', 'matcher us'))
+    for count in (10, 100, 1000, 5000, 10000):
+        # None of the configured domains appear in HEADERS as a domain, forcing a full scan
+        domains = ['domain{}.example'.format(x) for x in range(count)]
+        matcher = DomainMatcher(domains + ['*.sub{}.example'.format(x) for x in range(count)])
+
+        substring = timeit.timeit(lambda: substring_match(HEADERS, domains), number=args.number)
+        matched = timeit.timeit(lambda: matcher.match_headers(HEADERS), number=args.number)
+        print('{:>8}  {:>14.2f}  {:>14.2f}'.format(count,
+                                                    substring / args.number * 1e6,
+                                                    matched / args.number * 1e6))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
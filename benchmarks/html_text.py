@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Benchmark for HTML body extraction. Compares the previous bleach.clean path of the indexer against
+html_text.html_to_text on the text/html parts of archived mail (or a generated marketing mail corpus), and checks
+that both produce the same text.
+
+Outputs are compared with whitespace removed, after decoding the entities bleach leaves escaped. The bleach
+input has its <script> and <style> elements removed first, as html_to_text does not index their contents.
+bleach escapes the & of references missing their semicolon, which are decoded again.
+Fails if any document differs, or if html_to_text is not at least --min-speedup times faster.
+
+    python benchmarks/html_text.py --path /srv/archive/2020/01 --limit 2000
+"""
+import os
+import sys
+import time
+import argparse
+from html import unescape
+from email.parser import BytesParser
+
+import bleach
+
+from email_archive import message_utils
+from email_archive.html_text import html_to_text, SKIP_RE
+
+
+def generate_corpus(count):
+    """Marketing style mail: nested layout tables, inline styles, conditional comments and entities"""
+    corpus = []
+    for x in range(count):
+        rows = []
+        for row in range(40 + x % 60):
+            cells = ''.join('<td style="padding:4px;font-family:Arial,sans-serif" class="c{}">'
+                            '<table><tr><td><a href="https://example.com/?p={}&amp;r={}" title="a > b">'
+                            'Offer&nbsp;{} &ndash; save&#160;{}% on <b>item</b>s&hellip;</a></td></tr></table>'
+                            '</td>'.format(cell, row, cell, cell, row % 90) for cell in range(4))
+            rows.append('<tr>{}</tr>'.format(cells))
+        corpus.append('<!DOCTYPE html><html><head><title>Newsletter {}</title>'
+                      '<style type="text/css">td {{ color: #333; }} a > b {{ margin: 0 }}</style>'
+                      '<!--[if mso]><xml><o:OfficeDocumentSettings/></xml><![endif]--></head>'
+                      '<body><script>var x = 1 < 2;</script><div><p>Dear customer,<br>this week\'s deals:</p>'
+                      '<table width="100%">{}</table><p>Unsubscribe &copy; 2020 Caf&eacute; &amp; Co &lt;info&gt;'
+                      '</p></div></body></html>'.format(x, ''.join(rows)))
+    return corpus
+
+
+def load_corpus(path, limit):
+    """Decoded text/html parts of the messages stored under `path`"""
+    corpus = []
+    parser = BytesParser()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(x for x in dirs if not x.startswith('.'))
+        for filename in sorted(files):
+            if '.eml' not in filename:
+                continue
+            with message_utils.gz_open(os.path.join(root, filename)) as fd:
+                message = parser.parse(fd)
+            for part in message.walk():
+                if part.get_content_type() == 'text/html':
+                    payload = part.get_payload(decode=True) or b''
+                    corpus.append(payload.decode(part.get_content_charset() or 'utf8', 'replace'))
+            if len(corpus) >= limit:
+                return corpus[:limit]
+    return corpus
+
+
+def bleach_text(html):
+    """The indexer's previous HTML path"""
+    return bleach.clean(html, tags=[], attributes={}, styles=[], strip=True)
+
+
+def normalize(text):
+    return ''.join(text.split())
+
+
+def timed(fn, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for html in corpus:
+            fn(html)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', help='Archive subtree to take text/html parts from, generated mail otherwise')
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-speedup', type=float, default=5.0)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.path, args.limit) if args.path else generate_corpus(min(args.limit, 50))
+    size = sum(len(x) for x in corpus)
+    print('{} documents, {:.1f} MB'.format(len(corpus), size / 1e6))
+
+    mismatches = 0
+    for number, html in enumerate(corpus):
+        expected = normalize(unescape(unescape(bleach_text(SKIP_RE.sub(' ', html)))))
+        actual = normalize(html_to_text(html))
+        if expected != actual:
+            mismatches += 1
+            at = next((x for x, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+            print('Document {} differs at {}:\n  bleach: {!r}\n  html_to_text: {!r}'.format(
+                number, at, expected[max(at - 40, 0):at + 40], actual[max(at - 40, 0):at + 40]))
+
+    bleach_time = timed(bleach_text, corpus, args.repeat)
+    text_time = timed(html_to_text, corpus, args.repeat)
+    speedup = bleach_time / text_time
+    print('{:>14}  {:>10}  {:>10}'.format('', 'ms/doc', 'MB/s'))
+    for name, elapsed in (('bleach.clean', bleach_time), ('html_to_text', text_time)):
+        print('{:>14}  {:>10.3f}  {:>10.1f}'.format(name, elapsed / len(corpus) * 1000, size / elapsed / 1e6))
+    print('speedup {:.1f}x, {} of {} documents differ'.format(speedup, mismatches, len(corpus)))
+    return 1 if mismatches or speedup < args.min_speedup else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
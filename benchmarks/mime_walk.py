@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for MIME tree analysis. Compares the three walks the indexer used to make per message (body,
+attachment details and has-attachments) against a single message_utils.analyze, on generated messages of
+increasing depth, and checks that both find the same body and attachments. Every level ends with a part without
+a Content-Type header, which neither takes as the body. The walks only differ on headers in another case than
+text/html or text/plain, which analyze matches and the original walks did not.
+
+    python benchmarks/mime_walk.py
+"""
+import sys
+import timeit
+import argparse
+from email.header import Header
+from email.message import EmailMessage
+
+from email_archive import message_utils
+
+
+def original_get_body(message):
+    if not message.is_multipart():
+        return message
+    html_part = None
+    text_part = None
+    for part in message.walk():
+        content_type = part.get('Content-Type', 'application/octet-stream')
+        if isinstance(content_type, Header):
+            content_type = str(content_type)
+        if not part.is_multipart():
+            if 'text/html' in content_type:
+                html_part = part
+            if 'text/plain' in content_type:
+                text_part = part
+    return html_part or text_part or None
+
+
+def original_attachment_details(message):
+    attachments = []
+    for part in message.walk() if message.is_multipart() else [message]:
+        filename = part.get_filename('unknown.bin')
+        content_type = part.get_content_type()
+        if 'text/html' in content_type or 'text/plain' in content_type or content_type.startswith('multipart/'):
+            continue
+        attachments.append((filename, content_type))
+    return attachments
+
+
+def original_has_attachments(message):
+    if not message.is_multipart():
+        return False
+    found = False
+    for part in message.walk():
+        content_type = part.get('Content-Type', 'application/octet-stream')
+        if 'text/html' in content_type or 'text/plain' in content_type:
+            continue
+        found = True
+    return found
+
+
+def original(message):
+    return original_get_body(message), original_attachment_details(message), original_has_attachments(message)
+
+
+def generate_message(depth, attachments):
+    """A message forwarded `depth` times, each level with a text and HTML alternative, `attachments` files and a
+    part without headers"""
+    message = EmailMessage()
+    message.set_content('Level 0 text')
+    message.add_alternative('<p>Level 0 html</p>', subtype='html')
+    for level in range(1, depth + 1):
+        outer = EmailMessage()
+        outer.set_content('Level {} text'.format(level))
+        outer.add_alternative('<p>Level {} html</p>'.format(level), subtype='html')
+        for x in range(attachments):
+            outer.add_attachment(b'%PDF' * 256, maintype='application', subtype='pdf',
+                                 filename='level{}-{}.pdf'.format(level, x))
+        outer.add_attachment(message)
+        headerless = EmailMessage()
+        headerless.set_payload('Not a body')
+        outer.attach(headerless)
+        message = outer
+    return message
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    print('{:>6}  {:>6}  {:>14}  {:>14}'.format('depth', 'parts', 'original us', 'analyze us'))
+    for depth in (0, 2, 5, 10, 20):
+        message = generate_message(depth, attachments=3)
+        summary = message_utils.analyze(message)
+        body, attachments, _ = original(message)
+        if summary.body is not body or summary.attachment_details != attachments:
+            print('Results differ at depth {}'.format(depth))
+            return 1
+
+        walked = timeit.timeit(lambda: original(message), number=args.number)
+        analyzed = timeit.timeit(lambda: message_utils.analyze(message), number=args.number)
+        print('{:>6}  {:>6}  {:>14.1f}  {:>14.1f}'.format(depth, summary.part_count,
+                                                         walked / args.number * 1e6,
+                                                         analyzed / args.number * 1e6))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Cold-start benchmark for the email-archive CLI.
+
+Runs each scenario under `python -X importtime`, reports wall time, total import time and the
+most expensive imports, and fails if a scenario pulls in one of the heavy indexing dependencies
+or exceeds its time budget. Intended to be run from the repository root:
+
+    python benchmarks/startup.py --repeat 5 --max-ms 250
+"""
+import sys
+import time
+import argparse
+import subprocess
+
+
+# (name, argv, stdin, modules that must not be imported)
+SCENARIOS = [
+    ('import-cli', ['-c', 'import email_archive.cli'], b'',
+     ['elasticsearch', 'magic', 'bleach', 'html5lib', 'chardet', 'urllib3', 'arrow']),
+    # An empty message has no Message-ID and is skipped before configuration is read
+    ('archive-message', ['-m', 'email_archive.cli', 'archive-message'], b'',
+     ['elasticsearch', 'magic', 'bleach', 'html5lib', 'chardet', 'urllib3', 'arrow']),
+    ('queue-length-help', ['-m', 'email_archive.cli', 'queue-length', '--help'], b'',
+     ['elasticsearch', 'magic', 'bleach', 'html5lib', 'chardet', 'urllib3', 'arrow']),
+]
+
+
+def parse_importtime(stderr):
+    """Parse `-X importtime` output into {module: (self_us, cumulative_us)}"""
+    imports = {}
+    for line in stderr.decode('utf8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return imports
+
+
+def run_scenario(argv, stdin):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + argv,
+                          input=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    return elapsed, proc.returncode, parse_importtime(proc.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario, the fastest is reported')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list')
+    parser.add_argument('--max-ms', type=float, default=None, help='Fail if a scenario takes longer than this')
+    args = parser.parse_args()
+
+    failed = False
+    for name, argv, stdin, forbidden in SCENARIOS:
+        results = [run_scenario(argv, stdin) for _ in range(args.repeat)]
+        elapsed, returncode, imports = min(results, key=lambda x: x[0])
+        total_ms = sum(x[0] for x in imports.values()) / 1000.0
+
+        print('{}: wall={:.1f}ms imports={:.1f}ms modules={} exit={}'.format(
+            name, elapsed * 1000, total_ms, len(imports), returncode))
+        slowest = sorted(imports.items(), key=lambda x: x[1][1], reverse=True)[:args.top]
+        for module, (self_us, cumulative_us) in slowest:
+            print('    {:>9.1f}ms  {:>9.1f}ms  {}'.format(cumulative_us / 1000.0, self_us / 1000.0, module))
+
+        if returncode != 0:
+            print('  FAIL: exited with status {}'.format(returncode))
+            failed = True
+        loaded = sorted(x for x in forbidden if x in imports)
+        if loaded:
+            print('  FAIL: imports heavy modules: {}'.format(', '.join(loaded)))
+            failed = True
+        if args.max_ms is not None and elapsed * 1000 > args.max_ms:
+            print('  FAIL: {:.1f}ms exceeds budget of {:.1f}ms'.format(elapsed * 1000, args.max_ms))
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,51 +6,136 @@ import email.utils
 import email.parser
 import datetime
 import hashlib
-from gzip import open as gzip_open
 import logging
 import uuid
+import itertools
 
 import redis
 
 from .config import Configuration
-from .fifo import FIFOQueue
+from . import fifo
+from .domains import DomainMatcher
+from . import segments
+from . import compression
+from . import durable
 
 
 logger = logging.getLogger(__name__)
 
-
-
-def check_archived_domain(addresses, domains):
-    """Check addresses to see if any of them fall in the archived domain list.
-    This is lazy as a matched domain could appear in the local-part of the address
-    and trigger a match"""
-    if addresses is None: return
-    addresses = addresses.lower()
-    for address in addresses.split(','):
-        for domain in domains:
-            if domain in address:
-                return True
-
-
-def archive_message(message, priority=2):
-    """Parse an email.Message object and archive it if eligible"""
-    archived_domains = [x.lower() for x in Configuration.ARCHIVED_DOMAINS]
+DEDUP_TTL = 86400
+ADDRESS_HEADERS = ('To', 'From', 'CC', 'BCC')
+CHUNK_SIZE = 64 * 1024
+HEADER_LINE_LIMIT = 64 * 1024
+KNOWN_DIRS_LIMIT = 4096
+
+
+_pool = None
+def configure_pool():
+    """Configure a redis ConnectionPool shared by every archived message in this process"""
+    global _pool
+    _pool = redis.ConnectionPool.from_url(Configuration.REDIS['url'])
+
+
+def connect():
+    if _pool is None:
+        configure_pool()
+    return redis.StrictRedis(connection_pool=_pool)
+
+
+_matcher = None
+def get_domain_matcher():
+    """Return a DomainMatcher for the configured archived domains, built once per process"""
+    global _matcher
+    if _matcher is None:
+        _matcher = DomainMatcher(Configuration.ARCHIVED_DOMAINS)
+    return _matcher
+
+
+_committer = None
+def get_committer():
+    """Return the GroupCommitter shared by every archive write in this process"""
+    global _committer
+    if _committer is None:
+        _committer = durable.GroupCommitter(window=Configuration.STORAGE.get('commit_window', durable.DEFAULT_WINDOW),
+                                            fsync=Configuration.STORAGE.get('fsync', True))
+    return _committer
+
+
+_known_dirs = set()
+def make_dirs(path):
+    """Create `path` if needed. Directories known to exist are cached, only one new bucket appears every 10 minutes"""
+    if path in _known_dirs:
+        return
+    if len(_known_dirs) > KNOWN_DIRS_LIMIT:
+        _known_dirs.clear()
+
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # Ignore EEXIST
+        if e.errno != 17:
+            raise Exception('Unable to create directories')
+        _known_dirs.add(path)
+        return
+    _known_dirs.add(path)
+
+    if get_committer().fsync:
+        # Make the new directory entries durable, up to the archive root
+        parent = os.path.dirname(path)
+        while parent.startswith(Configuration.ARCHIVE_DIR):
+            durable.fsync_dir(parent)
+            if os.path.samefile(parent, Configuration.ARCHIVE_DIR):
+                break
+            parent = os.path.dirname(parent)
+
+
+def read_headers(fd):
+    """Read the header block, up to and including the blank separator line, from binary file `fd`"""
+    lines = []
+    while True:
+        line = fd.readline(HEADER_LINE_LIMIT)
+        lines.append(line)
+        if not line or line in (b'\r\n', b'\n'):
+            break
+    return b''.join(lines)
+
+
+def archive_stream(fd, priority=2, queue=None, matcher=None):
+    """Archive a message read from binary file `fd`. Only the header block is parsed, the original bytes
+    are streamed to the archive unchanged in chunks so memory use does not depend on message size"""
+    headers = read_headers(fd)
+    message = email.parser.BytesHeaderParser().parsebytes(headers)
+    chunks = itertools.chain([headers], iter(lambda: fd.read(CHUNK_SIZE), b''))
+    return archive_message(message, priority=priority, queue=queue, matcher=matcher, chunks=chunks)
+
+
+def archive_message(message, priority=2, queue=None, matcher=None, chunks=None):
+    """Parse an email.Message object and archive it if eligible.
+    Long-running callers can pass a pre-built `queue` and `matcher` to avoid
+    rebuilding them for every message. If `chunks`, an iterable of bytestrings holding the
+    original message, is given it is written as-is instead of re-serialising `message`"""
     do_archive = False
 
     if 'Message-ID' in message:
-        message_id = message['Message-ID']
-
-        for addresses in [message.get('To'), message.get('From'), message.get('CC'), message.get('BCC')]:
-            if check_archived_domain(addresses, archived_domains):
-                do_archive = True
+        message_id = str(message['Message-ID'])
+
+        if matcher is None:
+            matcher = get_domain_matcher()
+        addresses = []
+        for header in ADDRESS_HEADERS:
+            addresses.extend(message.get_all(header, []))
+        do_archive = matcher.match_headers(addresses)
     else:
         logger.debug('No Message-ID, duplicate checking unavailable')
         message_id = uuid.uuid4()
         return None
 
     if do_archive:
-        conn = redis.StrictRedis.from_url(Configuration.REDIS.get('url'))
-        queue = FIFOQueue(Configuration.REDIS['queue'], conn)
+        if queue is None:
+            queue = fifo.open_queue(connect())
+        if chunks is None:
+            chunks = [str(message).encode('utf8')]
+
         archive_date = message['Date']
         if archive_date is not None:
             archive_date = email.utils.parsedate(archive_date)
@@ -65,31 +150,44 @@ def archive_message(message, priority=2):
                                     archive_date.strftime('%m'),
                                     archive_date.strftime('%d'),
                                     '{}{}'.format(archive_date.strftime('%H'), str(minute).zfill(2)))
-        try:
-            os.makedirs(archive_path)
-        except OSError as e:
-            # Ignore EEXIST
-            if e.errno != 17:
-                raise Exception('Unable to create directories')
-
-        messagetime = archive_date.strftime('%H%M')
-        hash_id = hashlib.sha256(message_id.encode('utf8')).hexdigest()
-        archive_path = os.path.join(archive_path, messagetime + '-' + hash_id + '.eml.gz')
-        logger.debug('Archiving to {}'.format(archive_path))
-        with gzip_open(archive_path, 'w') as fd:
-            fd.write(str(message).encode('utf8'))
-
-        queue.push(archive_path.replace(Configuration.ARCHIVE_DIR, '').lstrip('/'), priority=priority)
+        if Configuration.STORAGE.get('backend', 'files') == 'segments':
+            # All messages in the 10 minute bucket share one segment file alongside the bucket directory
+            segment_dir, bucket = os.path.split(archive_path)
+            make_dirs(segment_dir)
+            hash_id = hashlib.sha256(message_id.encode('utf8')).hexdigest()
+            segment_path = os.path.join(segment_dir, bucket + segments.SEGMENT_SUFFIX)
+            offset, size = segments.append(segment_path, chunks, key=hash_id, committer=get_committer())
+            archive_path = segments.make_ref(segment_path, offset)
+            logger.debug('Archived to {}'.format(archive_path))
+        else:
+            messagetime = archive_date.strftime('%H%M')
+            hash_id = hashlib.sha256(message_id.encode('utf8')).hexdigest()
+            if Configuration.STORAGE.get('layout', 'flat') == 'sharded':
+                # Bound the size of bucket directories with a sub-directory per hash prefix
+                archive_path = os.path.join(archive_path, hash_id[:Configuration.STORAGE.get('shard_chars', 2)])
+            make_dirs(archive_path)
+            archive_path = os.path.join(archive_path, messagetime + '-' + hash_id + compression.extension())
+            logger.debug('Archiving to {}'.format(archive_path))
+            with get_committer().atomic_write(archive_path) as raw:
+                with compression.open_writer(fileobj=raw) as fd:
+                    for chunk in chunks:
+                        fd.write(chunk)
+                size = raw.tell()
+
+        first_seen = queue.push_tracked(archive_path.replace(Configuration.ARCHIVE_DIR, '').lstrip('/'),
+                                        priority=priority,
+                                        dedup_key=hash_id,
+                                        dedup_ttl=Configuration.REDIS.get('dedup_ttl', DEDUP_TTL),
+                                        size=size)
+        if not first_seen:
+            logger.info('Duplicate delivery of {}'.format(message_id))
 
         return archive_path
 
 
 def main():
     """Process a message coming from stdin. Postfix delivery will send it this way"""
-    str_message = sys.stdin.read()
-    parser = email.parser.HeaderParser()
-    message = parser.parsestr(str_message)
-    archive_message(message)
+    archive_stream(sys.stdin.buffer)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,371 @@
+"""
+asyncio variant of the index daemon. Queue pops and Elasticsearch bulk requests are asynchronous, so a single
+process keeps up to `concurrency` bulk requests in flight against a high-latency cluster. Message parsing is CPU
+bound and runs in a pool of worker processes.
+
+Requires the `async` extra (aiohttp) for AsyncElasticsearch.
+"""
+import os
+import signal
+import asyncio
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from email.parser import BytesParser
+
+import redis.asyncio
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.exceptions import NotFoundError, RequestError
+from elasticsearch.helpers import async_streaming_bulk
+
+from .config import Configuration, ConfigurationError
+from . import indexer
+from . import index_daemon
+from . import backpressure
+
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = 4
+
+
+def init_worker(paths):
+    """Load the daemon's configuration file in a parsing process, which starts unconfigured unless forked"""
+    try:
+        Configuration.set_paths(paths)
+    except ValueError:
+        # Forked after the configuration was loaded
+        pass
+
+
+_indexer = None
+def parse_item(item):
+    """Load, parse and prepare a queued item for indexing. Runs in a worker process, returns the action and the
+    body selection counts of the item."""
+    global _indexer
+    if _indexer is None:
+        _indexer = indexer.Indexer()
+    file_path = os.path.join(Configuration.ARCHIVE_DIR, item)
+    message_path = file_path.replace(Configuration.ARCHIVE_DIR, '').lstrip('/')
+    message = index_daemon.read_message(BytesParser(), item)
+    _indexer.body_selection.clear()
+    return _indexer.prepare_message(message_path, message), dict(_indexer.body_selection)
+
+
+class Limiter(object):
+    """Bounds the tasks in flight to `limit()`, which may change while tasks run"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.released = asyncio.Event()
+
+    async def acquire(self):
+        while self.active >= self.limit():
+            self.released.clear()
+            await self.released.wait()
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self.released.set()
+
+
+class AsyncIndexDaemon(object):
+
+    def __init__(self, priorities=None, batch_size=index_daemon.BATCH_SIZE, linger=index_daemon.LINGER,
+                 concurrency=CONCURRENCY, parse_workers=None, size_class=None):
+        self.pressure = backpressure.from_config(batch_size, concurrency=concurrency)
+        self.linger = linger
+        if Configuration.REDIS.get('backend', 'lists') != 'lists':
+            raise ConfigurationError('The async index daemon only supports the lists queue backend')
+        self.conn = redis.asyncio.StrictRedis.from_url(Configuration.REDIS['url'])
+        # Queue commands return awaitables on an asyncio connection
+        self.queue = index_daemon.open_queue(self.conn, priorities=priorities, size_class=size_class)
+        config = dict(Configuration.ELASTIC)
+        if config.get('verify_certs') is False:
+            import urllib3
+            urllib3.disable_warnings()
+        self.es = AsyncElasticsearch(**config)
+        self.executor = ProcessPoolExecutor(max_workers=parse_workers, initializer=init_worker,
+                                            initargs=(list(Configuration.paths),))
+        # Bound the number of bulk requests in flight, adapting to the load of the cluster
+        self.limiter = Limiter(lambda: self.pressure.concurrency)
+        self.stopping = asyncio.Event()
+        self.tasks = set()
+        # Index bookkeeping shared with the synchronous indexer, its connection is never used
+        self.indexer = indexer.Indexer()
+        self.body_selection = Counter()
+
+    async def pop_many(self, count):
+        return self.queue.pop_many_result(await self.queue.pop_many_command(count))
+
+    async def pop(self):
+        item = await self.conn.brpop(self.queue.queues, index_daemon.POP_TIMEOUT)
+        if not item:
+            return None
+        self.queue.sources[item[1]] = item[0]
+        return item[1]
+
+    async def collect_batch(self):
+        batch_size = self.pressure.batch_size
+        batch = await self.pop_many(batch_size)
+        if not batch:
+            if self.queue.reliable:
+                await asyncio.sleep(index_daemon.SLEEP_INTERVAL)
+                return []
+            item = await self.pop()
+            if not item:
+                return []
+            batch = [item]
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.linger
+        while len(batch) < batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            more = await self.pop_many(batch_size - len(batch))
+            if more:
+                batch.extend(more)
+            else:
+                await asyncio.sleep(min(index_daemon.LINGER_POLL, remaining))
+        return batch
+
+    async def retry(self, command, *args):
+        """Await `command(*args)` until Redis answers, reconnecting like the synchronous daemon. Gives up with the
+        RedisError once the daemon is stopping"""
+        while True:
+            try:
+                return await command(*args)
+            except redis.RedisError:
+                logger.exception('RedisError')
+                if self.stopping.is_set():
+                    raise
+                await asyncio.sleep(index_daemon.RECONNECT_INTERVAL)
+
+    async def mark_done(self, batch):
+        pipeline = self.conn.pipeline(transaction=False)
+        pipeline.hdel(self.queue.get_queue('enqueued'), *batch)
+        await pipeline.execute()
+
+    async def acknowledge(self, batch, failures, body_selection):
+        pipeline = self.conn.pipeline(transaction=False)
+        self.queue.clear_attempts(index_daemon.handled(batch, failures), pipeline=pipeline)
+        self.queue.ack(batch, pipeline=pipeline)
+        # record_body_selection clears the counts it is given, keep them for a retry
+        index_daemon.record_body_selection(self.queue, Counter(body_selection), pipeline)
+        await pipeline.execute()
+
+    async def finish(self, batch, failures):
+        """Record failures and acknowledge the batch"""
+        dead = await self.retry(self.queue.fail, failures) if failures else []
+        index_daemon.log_failures(failures, dead)
+        body_selection = Counter(self.body_selection)
+        self.body_selection.clear()
+        await self.retry(self.acknowledge, batch, failures, body_selection)
+
+    async def promote(self):
+        """Periodically push due retries back to their queue"""
+        while not self.stopping.is_set():
+            try:
+                promoted = await self.queue.promote_due()
+                if promoted:
+                    logger.info('Retrying {} items'.format(promoted))
+            except redis.RedisError:
+                logger.exception('RedisError')
+            try:
+                await asyncio.wait_for(self.stopping.wait(), index_daemon.PROMOTE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def requeue_expired(self):
+        """See FIFOQueue.requeue_expired"""
+        requeued = 0
+        for consumer in await self.conn.smembers(self.queue.get_queue('consumers')):
+            consumer = consumer.decode('utf8')
+            sources = await self.conn.hvals(self.queue.consumer_keys(consumer)[2])
+            requeued += await self.queue.requeue_expired_command(consumer, sources)
+        return requeued
+
+    async def reap(self):
+        """Periodically requeue items whose lease expired"""
+        while not self.stopping.is_set():
+            try:
+                requeued = await self.requeue_expired()
+                if requeued:
+                    logger.warning('Requeued {} items with expired leases'.format(requeued))
+            except redis.RedisError:
+                logger.exception('RedisError')
+            try:
+                await asyncio.wait_for(self.stopping.wait(), index_daemon.REAP_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def bulk(self, actions):
+        results = async_streaming_bulk(self.es, actions,
+                                       chunk_size=max(len(actions), 1),
+                                       max_chunk_bytes=indexer.BULK_MAX_BYTES,
+                                       raise_on_error=False,
+                                       raise_on_exception=False)
+        failed = []
+        position = 0
+        async for ok, info in results:
+            if not ok:
+                failed.append((actions[position], info))
+            position += 1
+        return failed
+
+    async def install_template(self):
+        """See Indexer.install_template"""
+        try:
+            installed = await self.es.indices.get_template(indexer.TEMPLATE_NAME)
+        except NotFoundError:
+            installed = {}
+        for method, kwargs in self.indexer.get_template_requests(installed):
+            await getattr(self.es.indices, method)(**kwargs)
+
+    async def ensure_indices(self, index_names):
+        """Create any of `index_names` that do not exist yet, see Indexer.ensure_indices"""
+        for index_name in self.indexer.unknown_indices(index_names):
+            if not await self.es.indices.exists(index_name):
+                try:
+                    await self.es.indices.create(**self.indexer.get_index_creation(index_name))
+                except RequestError as e:
+                    if not indexer.is_already_exists(e):
+                        raise
+            self.indexer.known_indices.add(index_name)
+
+    async def index_bulk(self, actions):
+        """See Indexer.index_bulk"""
+        await self.ensure_indices(action['_index'] for action in actions)
+        failed = await self.bulk(actions)
+        missing, failed = self.indexer.split_missing(failed)
+        if missing:
+            await self.ensure_indices(action['_index'] for action in missing)
+            failed.extend(await self.bulk(missing))
+        return failed
+
+    async def process_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        items = [x.decode('utf8') for x in batch]
+        results = await asyncio.gather(*[loop.run_in_executor(self.executor, parse_item, x) for x in items],
+                                       return_exceptions=True)
+
+        failures = []
+        actions = []
+        for item, result in zip(items, results):
+            if isinstance(result, Exception):
+                logger.error('Unhandled exception processing {}: {!r}'.format(item, result))
+                failures.append((item,) + indexer.describe_error(result))
+                continue
+            action, body_selection = result
+            self.body_selection.update(body_selection)
+            if action is not None:
+                actions.append((item, action))
+
+        if actions:
+            if self.queue.reliable:
+                await self.queue.renew(batch)
+            started = loop.time()
+            try:
+                errors = await self.index_bulk([action for _, action in actions])
+            except Exception as e:
+                logger.exception('Unhandled exception bulk indexing {} messages'.format(len(actions)))
+                failures.extend((item,) + indexer.describe_error(e) for item, _ in actions)
+                self.pressure.record(len(actions), loop.time() - started,
+                                     len(actions) if indexer.is_rejection(e) else 0)
+            else:
+                self.pressure.record(len(actions), loop.time() - started,
+                                     len([error for _, error in errors if indexer.is_rejection(error)]))
+                by_action = dict((id(action), item) for item, action in actions)
+                for action, error in errors:
+                    logger.error('Failed indexing {}: {}'.format(action['_source']['path'], error))
+                    failures.append((by_action[id(action)],) + indexer.describe_error(error))
+                logger.info('Indexed {} messages, {} failed'.format(len(actions) - len(errors), len(errors)))
+
+        await self.finish(batch, failures)
+
+    def start_batch(self, batch):
+        task = asyncio.ensure_future(self.process_batch(batch))
+        self.tasks.add(task)
+
+        def _done(task):
+            self.tasks.discard(task)
+            self.limiter.release()
+            if not task.cancelled() and task.exception() is not None:
+                logger.error('Batch failed: {!r}'.format(task.exception()))
+        task.add_done_callback(_done)
+
+    def stop(self):
+        self.stopping.set()
+
+    async def run(self):
+        try:
+            await self.install_template()
+            reaper = asyncio.ensure_future(self.reap()) if self.queue.reliable else None
+            promoter = asyncio.ensure_future(self.promote())
+
+            while not self.stopping.is_set():
+                # Bound the number of bulk requests in flight before taking more work off the queue
+                await self.limiter.acquire()
+                if self.pressure.delay:
+                    # The cluster is rejecting requests, give it time to catch up
+                    try:
+                        await asyncio.wait_for(self.stopping.wait(), self.pressure.delay)
+                    except asyncio.TimeoutError:
+                        pass
+                try:
+                    batch = await self.collect_batch()
+                except redis.RedisError:
+                    self.limiter.release()
+                    logger.exception('RedisError')
+                    await asyncio.sleep(index_daemon.RECONNECT_INTERVAL)
+                    continue
+                if not batch:
+                    self.limiter.release()
+                    continue
+                try:
+                    await self.retry(self.mark_done, batch)
+                except redis.RedisError:
+                    # Stopping, the batch stays leased in reliable mode
+                    self.limiter.release()
+                    logger.error('Dropped a batch of {} items'.format(len(batch)))
+                    continue
+                self.start_batch(batch)
+
+            logger.info('Waiting for {} batches in flight'.format(len(self.tasks)))
+            if self.tasks:
+                await asyncio.wait(self.tasks)
+            if reaper is not None:
+                await reaper
+            await promoter
+        finally:
+            await self.es.close()
+            await self.conn.close()
+            self.executor.shutdown()
+
+
+def run(priorities=None, batch_size=None, linger=None, concurrency=None, parse_workers=None, size_class=None):
+    """Run a daemon for every lane (see index_daemon.get_lanes) in one event loop. Each lane has its own
+    connections and pool of parsing processes"""
+    config = Configuration.INDEXER
+    if batch_size is None:
+        batch_size = config.get('batch_size', index_daemon.BATCH_SIZE)
+    if linger is None:
+        linger = config.get('linger', index_daemon.LINGER)
+    if concurrency is None:
+        concurrency = config.get('concurrency', CONCURRENCY)
+    if parse_workers is None:
+        parse_workers = config.get('workers')
+
+    async def main():
+        daemons = [AsyncIndexDaemon(priorities=priorities, batch_size=batch_size, linger=linger,
+                                    concurrency=concurrency, parse_workers=workers, size_class=lane)
+                   for lane, workers in index_daemon.get_lanes(parse_workers, size_class)]
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: [x.stop() for x in daemons])
+        await asyncio.gather(*[x.run() for x in daemons])
+
+    asyncio.run(main())
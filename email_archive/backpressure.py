@@ -0,0 +1,93 @@
+"""
+Adaptive bulk sizing. The load sent to Elasticsearch, batch size times (for the async daemon) the number of
+bulk requests in flight, follows additive increase / multiplicative decrease: every healthy bulk request grows
+it a little, every request that was rejected by the cluster (429, es_rejected_execution_exception) or took
+longer than the target latency halves it. Throughput settles just below what the cluster accepts, whatever its
+size. Batches grow to their full size before more requests are sent in parallel, and parallelism is given up
+first.
+
+After a rejection the daemon also pauses before its next request, doubling the pause while rejections continue.
+"""
+import logging
+
+from .config import Configuration
+
+
+logger = logging.getLogger(__name__)
+
+TARGET_LATENCY = 5.0
+MIN_BATCH_SIZE = 10
+MIN_DELAY = 0.5
+MAX_DELAY = 30.0
+
+
+class AIMD(object):
+
+    def __init__(self, maximum, minimum=1, increase=1.0, decrease=0.5):
+        self.value = float(maximum)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = increase
+        self.factor = decrease
+
+    def increase(self, step=None):
+        self.value = min(self.value + (self.step if step is None else step), self.maximum)
+
+    def decrease(self):
+        self.value = max(self.value * self.factor, self.minimum)
+
+    def __int__(self):
+        return int(self.value)
+
+
+class Backpressure(object):
+    """Tracks bulk request outcomes. `batch_size` and `concurrency` start at, and never exceed, the configured
+    values"""
+
+    def __init__(self, batch_size, concurrency=1, target_latency=TARGET_LATENCY, min_batch_size=MIN_BATCH_SIZE):
+        self.target_latency = target_latency
+        self.batch = AIMD(batch_size, minimum=min(min_batch_size, batch_size), increase=max(batch_size / 20.0, 1))
+        self.concurrency_limit = AIMD(concurrency)
+        self.delay = 0.0
+
+    @property
+    def batch_size(self):
+        return int(self.batch)
+
+    @property
+    def concurrency(self):
+        return int(self.concurrency_limit)
+
+    def record(self, count, latency, rejected):
+        """Record a bulk request of `count` actions that took `latency` seconds, `rejected` of which were refused
+        because the cluster is overloaded"""
+        if rejected:
+            self.delay = min(max(self.delay * 2, MIN_DELAY), MAX_DELAY)
+            self.slow_down()
+            logger.warning('{} of {} actions rejected, backing off: batch size {}, concurrency {}, '
+                           'pausing {:.1f}s'.format(rejected, count, self.batch_size, self.concurrency, self.delay))
+        elif latency > self.target_latency:
+            self.delay = 0.0
+            self.slow_down()
+            logger.info('Bulk request took {:.1f}s, backing off: batch size {}, concurrency {}'.format(
+                latency, self.batch_size, self.concurrency))
+        else:
+            self.delay = 0.0
+            if self.batch.value < self.batch.maximum:
+                self.batch.increase()
+            else:
+                # Grow by about one request per round of requests in flight, as TCP does per round trip
+                self.concurrency_limit.increase(1.0 / self.concurrency_limit.value)
+
+    def slow_down(self):
+        if self.concurrency_limit.value >= 2:
+            self.concurrency_limit.decrease()
+        else:
+            self.batch.decrease()
+
+
+def from_config(batch_size, concurrency=1):
+    config = Configuration.INDEXER
+    return Backpressure(batch_size, concurrency=concurrency,
+                        target_latency=config.get('target_latency', TARGET_LATENCY),
+                        min_batch_size=config.get('min_batch_size', MIN_BATCH_SIZE))
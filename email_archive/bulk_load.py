@@ -0,0 +1,143 @@
+"""
+Bulk load mode for large reindexes. Before the first message of an index is queued, refresh is disabled and
+replicas are dropped on it, so Elasticsearch neither builds a searchable segment every second nor indexes every
+document again on each replica. Once the backlog of an index has drained its original settings are restored,
+after optionally force merging it down to a single segment (before replicas are added back, so they copy the
+merged segment instead of merging themselves).
+
+Queues are FIFO per lane, so an index has drained once fewer items are left in every lane than were queued
+after its last item, and none of the items waiting for a retry or held by a reliable consumer (see
+FIFOQueue.in_flight) can be indexed into it. Items queued by other runs only delay the restore. Items popped without
+`redis.reliable` cannot be seen in flight, so the last batch of an index may be indexed with its settings restored.
+
+The original settings of tuned indices are kept in Redis until they are restored, `restore-index-settings`
+restores them after an interrupted bulk load.
+"""
+import json
+import time
+import logging
+import datetime
+from collections import Counter
+
+from . import fifo
+from . import indices
+
+
+logger = logging.getLogger(__name__)
+
+BULK_PRIORITY = 3
+POLL_INTERVAL = 10
+SETTINGS = ('index.refresh_interval', 'index.number_of_replicas')
+BULK_SETTINGS = {'index.refresh_interval': '-1', 'index.number_of_replicas': 0}
+FORCE_MERGE_TIMEOUT = 24 * 3600
+
+
+def get_index_names(path):
+    """Return the indices messages archived at `path` (relative to the archive) can be indexed into. Archive
+    directories use the sender's local date and indices the UTC date, so a message from the first or last day
+    of a month can belong to the neighbouring month. Returns an empty list for paths outside of the dated
+    archive tree or with rollover indices."""
+    parts = path.split('/')
+    try:
+        day = datetime.date(*[int(x) for x in parts[:3]])
+    except (TypeError, ValueError):
+        return []
+    if indices.is_rollover():
+        return []
+    return sorted(set(indices.get_index_name(day + datetime.timedelta(days=x)) for x in (-1, 0, 1)))
+
+
+class BulkLoad(object):
+
+    def __init__(self, idx, queue, force_merge=False):
+        if idx.es is None:
+            idx.connect()
+        self.indexer = idx
+        self.es = idx.es
+        self.queue = queue
+        self.force_merge = force_merge
+        self.state_key = queue.get_queue('bulk-load')
+        self.lanes = dict((x, fifo.open_queue(queue.connection, size_class=x))
+                          for x in [None] + [name for name, _ in queue.size_classes])
+        # Items pushed to each lane so far, and per tuned index the count at the time its last item was pushed
+        self.pushed = dict((x, 0) for x in self.lanes)
+        self.marks = {}
+
+    def push(self, item, size=None):
+        """Queue `item`, a path relative to the archive, tuning the indices it can end up in first"""
+        index_names = get_index_names(item)
+        for index_name in index_names:
+            if index_name not in self.marks:
+                self.tune(index_name)
+        size_class = self.queue.classify(size)
+        self.queue.push(item, priority=BULK_PRIORITY, size_class=size_class)
+        self.pushed[size_class] += 1
+        for index_name in index_names:
+            self.marks[index_name] = dict(self.pushed)
+
+    def tune(self, index_name):
+        self.indexer.ensure_indices([index_name])
+        current = self.es.indices.get_settings(index=index_name, name=SETTINGS, flat_settings=True)
+        settings = current.get(index_name, {}).get('settings', {})
+        # Settings that are not set explicitly are stored as None, which resets them to their default
+        original = dict((x, settings.get(x)) for x in SETTINGS)
+        # Keep the settings saved by an earlier, interrupted run, they are the real originals
+        if self.queue.connection.hsetnx(self.state_key, index_name, json.dumps(original)):
+            logger.info('Tuning {} for bulk loading, was {}'.format(index_name, original))
+        self.es.indices.put_settings(index=index_name, body=BULK_SETTINGS)
+        self.marks[index_name] = dict(self.pushed)
+
+    def pending(self):
+        """Count the items waiting for a retry or in flight per index they can be indexed into"""
+        items = set(item for item, _ in self.queue.connection.zscan_iter(self.queue.get_queue('retry')))
+        for lane in self.lanes.values():
+            items.update(lane.in_flight())
+        return Counter(index_name for item in items for index_name in get_index_names(item.decode('utf8')))
+
+    def remaining(self, index_name, pending=None):
+        """Number of items that can be indexed into `index_name` and have not been yet: queued ones that have not
+        been taken off their lane, and those in `pending` (see `pending`)"""
+        if pending is None:
+            pending = self.pending()
+        mark = self.marks[index_name]
+        return pending[index_name] + sum(max(0, self.lanes[x].queue_length(BULK_PRIORITY) - (self.pushed[x] - mark[x]))
+                                         for x in self.lanes if mark[x])
+
+    def finish_drained(self):
+        """Restore the indices whose backlog has drained, returns their names"""
+        pending = self.pending()
+        drained = [x for x in sorted(self.marks) if not self.remaining(x, pending)]
+        for index_name in drained:
+            self.restore(index_name)
+            del self.marks[index_name]
+        return drained
+
+    def wait(self, interval=POLL_INTERVAL):
+        """Restore every tuned index as soon as its backlog drains"""
+        while self.marks:
+            if not self.finish_drained():
+                pending = self.pending()
+                logger.info('Waiting for {} indices to drain, {} items left'.format(
+                    len(self.marks), max(self.remaining(x, pending) for x in self.marks)))
+                time.sleep(interval)
+
+    def restore(self, index_name):
+        saved = self.queue.connection.hget(self.state_key, index_name)
+        original = json.loads(saved) if saved else dict((x, None) for x in SETTINGS)
+        self.es.indices.put_settings(index=index_name, body={'index.refresh_interval':
+                                                             original['index.refresh_interval']})
+        if self.force_merge:
+            logger.info('Force merging {}'.format(index_name))
+            self.es.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=FORCE_MERGE_TIMEOUT)
+        self.es.indices.put_settings(index=index_name, body={'index.number_of_replicas':
+                                                             original['index.number_of_replicas']})
+        self.queue.connection.hdel(self.state_key, index_name)
+        logger.info('Restored settings of {}'.format(index_name))
+
+    def restore_all(self):
+        """Restore every index tuned by this or an earlier run, returns their names"""
+        index_names = sorted(x.decode('utf8') for x in self.queue.connection.hkeys(self.state_key))
+        for index_name in index_names:
+            self.restore(index_name)
+        self.marks.clear()
+        return index_names
@@ -5,6 +5,7 @@ import email.utils
 import email.parser
 import logging
 import time
+import random
 from pathlib import Path
 from email.parser import BytesParser
 
@@ -12,10 +13,9 @@ import click
 import redis
 
 from . import archive
-from . import indexer
-from . import message_utils
-from . import index_daemon as daemon_module
-from .fifo import FIFOQueue
+from . import segments
+from . import durable
+from . import fifo
 from .config import Configuration
 
 
@@ -34,28 +34,56 @@ def main(config=None):
 @click.option('--path', required=False)
 def archive_message(path=None):
     if path is None:
-        str_message = sys.stdin.read()
+        archive.archive_stream(sys.stdin.buffer)
     else:
-        with open(path) as fd:
-            str_message = fd.read()
+        with open(path, 'rb') as fd:
+            archive.archive_stream(fd)
 
-    parser = email.parser.HeaderParser()
-    message = parser.parsestr(str_message)
-    archive.archive_message(message)
+
+@main.command()
+@click.option('--socket', 'path', required=False, help='Listen on this unix socket path')
+@click.option('--host', required=False, help='Listen on this TCP address')
+@click.option('--port', required=False, type=int)
+@click.option('--workers', required=False, type=int, help='Number of archive writer threads')
+def lmtp_server(path=None, host=None, port=None, workers=None):
+    """Run a persistent LMTP server that archives delivered messages"""
+    from . import lmtp
+    lmtp.run(path=path, host=host, port=port, workers=workers)
 
 
 @main.command()
 @click.option('--priorities', multiple=True)
-def index_daemon(priorities):
+@click.option('--batch-size', required=False, type=int, help='Maximum messages per bulk request')
+@click.option('--linger', required=False, type=float, help='Maximum seconds to wait for a batch to fill')
+@click.option('--workers', required=False, type=int, help='Number of worker processes to fork')
+@click.option('--max-messages-per-child', 'max_messages', required=False, type=int,
+              help='Recycle worker processes after this many messages')
+@click.option('--async', 'use_async', is_flag=True, default=False,
+              help='Run the asyncio daemon, --workers sets the number of parsing processes')
+@click.option('--concurrency', required=False, type=int, help='Bulk requests in flight at once (--async only)')
+@click.option('--size-class', required=False,
+              help='Only index this size class ("default" for the smallest), instead of a lane for every class')
+def index_daemon(priorities, batch_size=None, linger=None, workers=None, max_messages=None, use_async=False,
+                 concurrency=None, size_class=None):
     if not priorities:
         priorities = None
-    daemon_module.run(priorities)
+    if use_async:
+        from . import async_daemon
+        async_daemon.run(priorities, batch_size=batch_size, linger=linger, concurrency=concurrency,
+                         parse_workers=workers, size_class=size_class)
+        return
+    from . import index_daemon as daemon_module
+    daemon_module.run(priorities, batch_size=batch_size, linger=linger, workers=workers, max_messages=max_messages,
+                      size_class=size_class)
 
 
 @main.command()
 @click.argument('paths', nargs=-1)
 def index_message(paths):
     """Index messages specified"""
+    from . import indexer
+    from . import message_utils
+
     # Check that the subtree is actually contained within the index path
     for path in paths:
         archive_dir = Path(Configuration.ARCHIVE_DIR)
@@ -82,7 +110,11 @@ def index_message(paths):
 
 @main.command()
 @click.argument('path')
-def bulk_index(path):
+@click.option('--bulk-load', is_flag=True,
+              help='Disable refresh and replicas on the affected indices until their backlog, retries and items in '
+                   'flight are indexed. Items in flight are only seen with redis.reliable or the streams backend')
+@click.option('--force-merge', is_flag=True, help='With --bulk-load, force merge each index once it is loaded')
+def bulk_index(path, bulk_load=False, force_merge=False):
     """Update the index or a subtree of the index in bulk"""
     # Check that the subtree is actually contained within the index path
     archive_dir = Path(Configuration.ARCHIVE_DIR)
@@ -94,14 +126,139 @@ def bulk_index(path):
         sys.exit(1)
 
     conn = redis.StrictRedis.from_url(Configuration.REDIS.get('url'))
-    queue = FIFOQueue(Configuration.REDIS['queue'], conn)
+    queue = fifo.open_queue(conn)
+    loader = None
+    if bulk_load:
+        from . import bulk_load as bulk_load_mode
+        from . import indexer
+        from . import indices
+        if indices.is_rollover():
+            logger.warning('--bulk-load does not tune rollover indices')
+        loader = bulk_load_mode.BulkLoad(indexer.Indexer(), queue, force_merge=force_merge)
+
+    last_check = time.monotonic()
+    for ref, size in walk_archive(path, sizes=bool(queue.size_classes)):
+        path_to_index = ref.replace(str(archive_dir), '').lstrip('/')
+        if loader is None:
+            queue.push(path_to_index, priority=3, size=size)
+        else:
+            loader.push(path_to_index, size=size)
+            # Months are walked in order, restore earlier ones as soon as they are indexed
+            if time.monotonic() - last_check > bulk_load_mode.POLL_INTERVAL:
+                loader.finish_drained()
+                last_check = time.monotonic()
+        logger.info('Queueing indexing of {}'.format(ref))
+
+    if loader is not None:
+        try:
+            loader.wait()
+        except KeyboardInterrupt:
+            logger.warning('Interrupted, restoring the settings of {} indices still being indexed'.format(
+                len(loader.marks)))
+            loader.restore_all()
+
+
+@main.command()
+@click.option('--force-merge', is_flag=True, help='Force merge each index before restoring its replicas')
+def restore_index_settings(force_merge=False):
+    """Restore the settings of indices left tuned by an interrupted bulk-index --bulk-load"""
+    from . import bulk_load
+    from . import indexer
+
+    conn = redis.StrictRedis.from_url(Configuration.REDIS.get('url'))
+    loader = bulk_load.BulkLoad(indexer.Indexer(), fifo.open_queue(conn), force_merge=force_merge)
+    for index_name in loader.restore_all():
+        logger.info('Restored {}'.format(index_name))
 
+
+@main.command()
+@click.option('--months-ahead', default=1, help='Also create the indices of this many upcoming months')
+def ensure_indices(months_ahead=1):
+    """Install the index template and create the current index and upcoming ones, or with rollover indices roll
+    the write alias over if the current index meets the rollover conditions"""
+    import arrow
+    from . import indexer
+    from . import indices
+
+    idx = indexer.Indexer()
+    if indices.is_rollover():
+        new_index = idx.rollover()
+        logger.info('Rolled over to {}'.format(new_index) if new_index else 'Rollover conditions not met')
+        return
+    now = arrow.utcnow()
+    index_names = indices.get_index_names(now, now.shift(months=months_ahead))
+    created = idx.ensure_indices(index_names)
+    for index_name in index_names:
+        logger.info('{} {}'.format(index_name, 'created' if index_name in created else 'exists'))
+
+
+@main.command()
+@click.option('--since', required=False, help='First date (YYYY-MM-DD, UTC) of the messages to search')
+@click.option('--until', required=False, help='Last date (YYYY-MM-DD, UTC) of the messages to search')
+def resolve_indices(since=None, until=None):
+    """Print the indices to search for messages sent in a date range, comma separated"""
+    from . import indices
+
+    print(','.join(indices.resolve_indices(since, until)))
+
+
+@main.command()
+@click.option('--path', required=False, help='Sample messages from this subtree of the archive')
+@click.option('--samples', default=10000, help='Number of messages to sample')
+@click.option('--size', default=112640, help='Dictionary size in bytes')
+def train_dictionary(path=None, samples=10000, size=112640):
+    """Train a Zstandard dictionary on a random sample of archived messages"""
+    from . import compression
+    from . import message_utils
+
+    archive_dir = Path(Configuration.ARCHIVE_DIR)
+    path = Path(path).absolute() if path else archive_dir
+
+    # Reservoir sample, the archive is too large to list up front
+    sampled = []
+    for seen, (ref, _) in enumerate(walk_archive(path)):
+        if len(sampled) < samples:
+            sampled.append(ref)
+        else:
+            replace = random.randint(0, seen)
+            if replace < samples:
+                sampled[replace] = ref
+    logger.info('Sampled {} messages'.format(len(sampled)))
+
+    data = []
+    for ref in sampled:
+        fd = message_utils.gz_open(ref)
+        try:
+            data.append(fd.read())
+        finally:
+            fd.close()
+
+    dictionary = compression.train_dictionary(data, size)
+    dictionary_path = compression.save_dictionary(dictionary)
+    logger.info('Wrote dictionary {} to {}'.format(dictionary.dict_id(), dictionary_path))
+    print('Set storage.zstd_dictionary: {} to compress new messages with this dictionary'.format(dictionary.dict_id()))
+
+
+def walk_archive(path, sizes=False):
+    """Yield the path (or segment reference) of every message stored under `path` with its compressed size.
+    The size of files is only looked up with `sizes`, otherwise it is None"""
     for root, dirs, files in os.walk(path):
-        for filename in files:
+        # Skip internal directories such as compression dictionaries, walk dates in order
+        dirs[:] = sorted(x for x in dirs if not x.startswith('.'))
+        for filename in sorted(files):
             full_file_path = Path(root) / Path(filename)
-            path_to_index = str(full_file_path).replace(str(archive_dir), '').lstrip('/')
-            queue.push(path_to_index, priority=3)
-            logger.info('Queueing indexing of {}'.format(full_file_path))
+            if filename.endswith(segments.INDEX_SUFFIX) or filename.endswith(durable.TMP_SUFFIX):
+                continue
+            elif filename.endswith(segments.SEGMENT_SUFFIX):
+                try:
+                    members = [x[:2] for x in segments.iter_index(str(full_file_path))]
+                except FileNotFoundError:
+                    logger.warning('Segment {} has no index, skipping'.format(full_file_path))
+                    continue
+                for offset, length in members:
+                    yield segments.make_ref(str(full_file_path), offset), length
+            else:
+                yield str(full_file_path), os.path.getsize(full_file_path) if sizes else None
 
 
 @main.group()
@@ -109,38 +266,101 @@ def manage_failed():
     pass
 
 
-@manage_failed.command()
-@click.option('--priority', default=1)
-def retry(priority=1):
+def failed_filters(f):
+    """Options selecting dead lettered items, shared by the manage-failed commands"""
+    f = click.option('--error-type', required=False, help='Only items that failed with this error type')(f)
+    f = click.option('--since', required=False, help='Only items that failed since this date or time')(f)
+    f = click.option('--path-prefix', required=False, help='Only items whose path starts with this prefix')(f)
+    return f
+
+
+def open_dead_letters():
     conn = redis.StrictRedis.from_url(Configuration.REDIS.get('url'))
-    queue = FIFOQueue(Configuration.REDIS['queue'], conn)
+    dead_letters = fifo.open_queue(conn).dead_letters
+    migrated = dead_letters.migrate()
+    if migrated:
+        logger.info('Migrated {} items from the old failed list'.format(migrated))
+    return dead_letters
+
 
-    queue_contents = conn.lrange(queue.get_queue('failed'), 0, -1)
-    logger.info('Retrying {} failed items, priority={}'.format(len(queue_contents), priority))
-    for entry in queue_contents:
-        queue.push(entry, priority=priority)
+def get_filters(error_type=None, since=None, path_prefix=None):
+    if since is not None:
+        import arrow
+        since = arrow.get(since).float_timestamp
+    return dict(error_type=error_type, since=since, path_prefix=path_prefix)
+
+
+@manage_failed.command('list')
+@failed_filters
+def list_failed(error_type=None, since=None, path_prefix=None):
+    """List dead lettered items with the time, type and message of their last error"""
+    dead_letters = open_dead_letters()
+    for batch in dead_letters.scan(**get_filters(error_type, since, path_prefix)):
+        for entry_id, fields in batch:
+            failed_at = int(entry_id.decode('ascii').partition('-')[0]) / 1000.0
+            print('{} {} {} attempts={} {}'.format(
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(failed_at)), fields['path'],
+                fields.get('type') or '-', fields.get('attempts'), fields.get('message', '')))
 
 
 @manage_failed.command()
-def purge():
-    conn = redis.StrictRedis.from_url(Configuration.REDIS.get('url'))
-    queue = FIFOQueue(Configuration.REDIS['queue'], conn)
+@click.option('--priority', default=1)
+@failed_filters
+def retry(priority=1, error_type=None, since=None, path_prefix=None):
+    """Queue dead lettered items again, removing them from the dead letters"""
+    dead_letters = open_dead_letters()
+    retried = dead_letters.retry(priority=priority, **get_filters(error_type, since, path_prefix))
+    logger.info('Retried {} failed items, priority={}'.format(retried, priority))
+
 
-    list_name = queue.get_queue('failed')
-    queue_length = conn.llen(list_name)
-    logger.info('Purging {} from failed items list'.format(queue_length))
-    conn.delete(list_name)
+@manage_failed.command()
+@failed_filters
+def purge(error_type=None, since=None, path_prefix=None):
+    """Delete dead lettered items"""
+    dead_letters = open_dead_letters()
+    purged = dead_letters.purge(**get_filters(error_type, since, path_prefix))
+    logger.info('Purged {} failed items'.format(purged))
+
+
+@main.command()
+@click.option('--reset', is_flag=True, help='Clear the counts after printing them')
+def body_stats(reset=False):
+    """Print how message bodies were selected under each body policy, and the HTML processing skipped"""
+    from . import index_daemon
+
+    conn = redis.StrictRedis.from_url(Configuration.REDIS.get('url'))
+    key = fifo.open_queue(conn).get_queue(index_daemon.BODY_SELECTION)
+    counts = {}
+    for name, count in conn.hgetall(key).items():
+        policy, outcome = name.decode('utf8').split(':', 1)
+        counts.setdefault(policy, {})[outcome] = int(count)
+    for policy, outcome in sorted(counts.items()):
+        html = outcome.get('html', 0)
+        skipped = outcome.get('html_skipped', 0)
+        print('{}: html={} text={} html_skipped={} ({:.1f} MB), {:.0%} of HTML bodies skipped'.format(
+            policy, html, outcome.get('text', 0), skipped, outcome.get('html_skipped_bytes', 0) / 1e6,
+            skipped / float(html + skipped) if html + skipped else 0))
+    if reset:
+        conn.delete(key)
 
 
 @main.command()
 @click.option('--monitor/--no-monitor', default=False)
 def queue_length(monitor=False):
     conn = redis.StrictRedis.from_url(Configuration.REDIS.get('url'))
-    queue = FIFOQueue(Configuration.REDIS['queue'], conn)
-    priorities = list(queue.priorities) + ['failed']
+    queue = fifo.open_queue(conn)
+    queues = [queue] + [fifo.open_queue(conn, size_class=name) for name, _ in queue.size_classes]
+    lanes = [(x, x.lane(priority, x.size_class), priority) for x in queues for priority in x.priorities]
+    lanes.append((queue, 'retry', 'retry'))
+    lanes.append((queue, 'failed', 'failed'))
     if not monitor:
-        for priority in priorities:
-            print('{}:{} len={}'.format(queue.queue_name, priority, queue.queue_length(priority)))
+        for lane_queue, lane, priority in lanes:
+            print('{}:{} len={}'.format(queue.queue_name, lane, lane_queue.queue_length(priority)))
+        for lane_queue in queues:
+            if isinstance(lane_queue, fifo.StreamQueue):
+                for priority, consumer, pending, idle in lane_queue.consumer_info():
+                    print('{}:{} consumer={} pending={} idle={:.1f}s'.format(
+                        queue.queue_name, lane_queue.lane(priority, lane_queue.size_class), consumer, pending, idle))
     else:
         try:
             INTERVAL = 5
@@ -148,11 +368,11 @@ def queue_length(monitor=False):
             last = {}
             first = True
             while True:
-                for priority in priorities:
-                    last[priority] = state.get(priority, 0)
-                    state[priority] = queue.queue_length(priority)
+                for lane_queue, lane, priority in lanes:
+                    last[lane] = state.get(lane, 0)
+                    state[lane] = lane_queue.queue_length(priority)
                     if not first:
-                        change = state[priority] - last[priority]
+                        change = state[lane] - last[lane]
                         if change != 0:
                             rate = round(change/INTERVAL)
                         else:
@@ -160,7 +380,7 @@ def queue_length(monitor=False):
                     else:
                         change = 0
                         rate = 0
-                    print('{}:{} len={} change={} rate={}'.format(queue.queue_name, priority, state[priority], change, rate))
+                    print('{}:{} len={} change={} rate={}'.format(queue.queue_name, lane, state[lane], change, rate))
                 time.sleep(INTERVAL)
                 first = False
         except KeyboardInterrupt:
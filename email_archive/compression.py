@@ -0,0 +1,166 @@
+"""
+Archive codecs. Messages can be stored gzip or Zstandard compressed, or uncompressed. Readers detect the
+format from the leading magic bytes so archives written with different codecs can be mixed freely.
+
+Zstandard can use a dictionary trained on existing mail (see the `train-dictionary` command). Dictionaries
+are stored in the archive under `.dictionaries/<dict_id>.zdict`, and the dictionary needed to read a
+frame is looked up by the id recorded in the frame header.
+"""
+import os
+import gzip
+import zlib
+from contextlib import nullcontext
+
+from .config import Configuration, ConfigurationError
+from .altgzip import AltGzipFile
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+CODECS = ('gzip', 'zstd', 'none')
+EXTENSIONS = {
+    'gzip': '.eml.gz',
+    'zstd': '.eml.zst',
+    'none': '.eml'
+}
+# Default, lowest and highest level of each codec. Negative zstd levels are its fast modes
+LEVELS = {
+    'gzip': (9, 0, 9),
+    'zstd': (3, -(1 << 17), 22)
+}
+DICTIONARY_DIR = '.dictionaries'
+DICTIONARY_SUFFIX = '.zdict'
+READ_SIZE = 64 * 1024
+
+
+_dictionaries = {}
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ConfigurationError('The zstd codec requires the zstandard package (pip install email_archive[zstd])')
+    return zstandard
+
+
+def get_codec():
+    codec = Configuration.STORAGE.get('codec', 'gzip')
+    if codec not in CODECS:
+        raise ConfigurationError('Unknown storage codec {}, expected one of {}'.format(codec, ', '.join(CODECS)))
+    return codec
+
+
+def get_level(codec):
+    """Compression level of `codec`, from `storage.gzip_level` or `storage.zstd_level`. `storage.level`, used by
+    earlier versions, still applies to the configured codec."""
+    default, minimum, maximum = LEVELS[codec]
+    config = Configuration.STORAGE
+    key = '{}_level'.format(codec)
+    if key not in config and codec == get_codec():
+        key = 'level'
+    level = config.get(key, default)
+    if isinstance(level, bool) or not isinstance(level, int) or not minimum <= level <= maximum:
+        raise ConfigurationError('Invalid {} level {}, expected {} to {}'.format(codec, level, minimum, maximum))
+    return level
+
+
+def dictionary_dir():
+    return os.path.join(Configuration.ARCHIVE_DIR, DICTIONARY_DIR)
+
+
+def load_dictionary(dict_id):
+    """Load (and cache) a trained Zstandard dictionary by id"""
+    dict_id = int(dict_id)
+    if dict_id not in _dictionaries:
+        zstandard = _zstd()
+        with open(os.path.join(dictionary_dir(), '{}{}'.format(dict_id, DICTIONARY_SUFFIX)), 'rb') as fd:
+            _dictionaries[dict_id] = zstandard.ZstdCompressionDict(fd.read())
+    return _dictionaries[dict_id]
+
+
+def save_dictionary(dictionary):
+    """Store a trained dictionary in the archive, returns its path"""
+    os.makedirs(dictionary_dir(), exist_ok=True)
+    path = os.path.join(dictionary_dir(), '{}{}'.format(dictionary.dict_id(), DICTIONARY_SUFFIX))
+    with open(path, 'wb') as fd:
+        fd.write(dictionary.as_bytes())
+    return path
+
+
+def _compressor():
+    zstandard = _zstd()
+    dict_id = Configuration.STORAGE.get('zstd_dictionary')
+    dictionary = load_dictionary(dict_id) if dict_id else None
+    return zstandard.ZstdCompressor(level=get_level('zstd'), dict_data=dictionary, write_checksum=True)
+
+
+def _decompressor(header):
+    zstandard = _zstd()
+    dict_id = zstandard.get_frame_parameters(header).dict_id
+    return zstandard.ZstdDecompressor(dict_data=load_dictionary(dict_id) if dict_id else None)
+
+
+def extension(codec=None):
+    return EXTENSIONS[codec or get_codec()]
+
+
+def open_writer(path=None, codec=None, fileobj=None, framed=False):
+    """Open `path`, or wrap the binary file `fileobj`, for writing with the configured codec. With `framed`,
+    the 'none' codec falls back to gzip without compression so the output is self-delimiting when
+    appended to a segment. Closing (or exiting) the writer does not close `fileobj`."""
+    codec = codec or get_codec()
+    if codec == 'zstd':
+        if fileobj is None:
+            return _compressor().stream_writer(open(path, 'wb'))
+        return _compressor().stream_writer(fileobj, closefd=False)
+    elif codec == 'gzip' or framed:
+        level = get_level('gzip') if codec == 'gzip' else 0
+        if fileobj is None:
+            return gzip.open(path, 'wb', compresslevel=level)
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level)
+    elif fileobj is None:
+        return open(path, 'wb')
+    return nullcontext(fileobj)
+
+
+def open_reader(fd):
+    """Wrap an open binary file, positioned at the start of a message, in a decompressing reader.
+    Zstandard readers stop at the end of the frame."""
+    start = fd.tell()
+    header = fd.read(18)
+    fd.seek(start)
+    if header.startswith(GZIP_MAGIC):
+        return AltGzipFile(fileobj=fd)
+    elif header.startswith(ZSTD_MAGIC):
+        return _decompressor(header).stream_reader(fd, closefd=True)
+    return fd
+
+
+def read_member(fd):
+    """Decompress the single gzip member or zstd frame at the current position of `fd`. Members that follow it
+    are not read."""
+    start = fd.tell()
+    header = fd.read(18)
+    fd.seek(start)
+    if header.startswith(ZSTD_MAGIC):
+        decompressor = _decompressor(header).decompressobj()
+    elif header.startswith(GZIP_MAGIC):
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    else:
+        raise ValueError('Unrecognized member at offset {}'.format(start))
+
+    # Both decompressors stop at the end of the member, leaving the rest of the last chunk unused
+    chunks = []
+    while not decompressor.eof:
+        chunk = fd.read(READ_SIZE)
+        if not chunk:
+            raise EOFError('Truncated member at offset {}'.format(start))
+        chunks.append(decompressor.decompress(chunk))
+    return b''.join(chunks)
+
+
+def train_dictionary(samples, size):
+    """Train a Zstandard dictionary of `size` bytes from a list of message bytestrings"""
+    return _zstd().train_dictionary(size, samples)
@@ -32,6 +32,9 @@ class _Configuration(object):
     _ARCHIVED_DOMAINS = None
     _ELASTIC = None
     _REDIS = None
+    _LMTP = None
+    _STORAGE = None
+    _INDEXER = None
 
     def __init__(self):
         self.paths = [os.path.join(os.getcwd(), 'email_archive.yml'),
@@ -57,6 +60,9 @@ class _Configuration(object):
         self._ARCHIVED_DOMAINS = conf['main'].get('archived_domains', [])
         self._ELASTIC = conf['main'].get('elastic', {})
         self._REDIS = conf['main'].get('redis', {})
+        self._LMTP = conf['main'].get('lmtp', {})
+        self._STORAGE = conf['main'].get('storage', {})
+        self._INDEXER = conf['main'].get('indexer', {})
         self._loaded = path
 
     def __repr__(self):
@@ -85,5 +91,20 @@ class _Configuration(object):
     def REDIS(self):
         return self._REDIS
 
+    @property
+    @wrap_load
+    def LMTP(self):
+        return self._LMTP
+
+    @property
+    @wrap_load
+    def STORAGE(self):
+        return self._STORAGE
+
+    @property
+    @wrap_load
+    def INDEXER(self):
+        return self._INDEXER
+
 
 Configuration = _Configuration()
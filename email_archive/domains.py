@@ -0,0 +1,48 @@
+import email.utils
+from email.header import Header
+
+
+class DomainMatcher(object):
+    """
+    Matches email addresses against a list of archived domains. Built once from configuration, matching
+    costs one set lookup per label of the address' domain regardless of how many domains are configured.
+
+    Entries may be plain domains (`example.com`), which match that domain and any subdomain of it, as the
+    substring match this replaces did, or wildcards (`*.example.com`), which only match subdomains. Unlike the
+    substring match, domains only match on label boundaries: `example.com` does not match `notexample.com`.
+    """
+
+    def __init__(self, domains):
+        self.domains = set()
+        self.wildcard = set()
+        for domain in domains:
+            domain = domain.strip().lower().rstrip('.')
+            if domain.startswith('*.'):
+                self.wildcard.add(domain[2:])
+            else:
+                self.domains.add(domain)
+
+    def match_domain(self, domain):
+        domain = domain.lower().rstrip('.')
+        if domain in self.domains:
+            return True
+        # Walk parent domains: a.b.example.com -> b.example.com -> example.com -> com
+        dot = domain.find('.')
+        while dot != -1:
+            domain = domain[dot + 1:]
+            if domain in self.domains or domain in self.wildcard:
+                return True
+            dot = domain.find('.')
+        return False
+
+    def match_address(self, address):
+        _, _, domain = address.rpartition('@')
+        return bool(domain) and self.match_domain(domain)
+
+    def match_headers(self, values):
+        """Check a list of address header values (eg. all To/From/CC/BCC headers of a message)"""
+        values = [str(x) if isinstance(x, Header) else x for x in values if x is not None]
+        for _, address in email.utils.getaddresses(values):
+            if self.match_address(address):
+                return True
+        return False
@@ -0,0 +1,126 @@
+"""
+Durable archive writes. Files are written under a temporary name, fsynced and atomically renamed into place,
+so a crash never leaves a truncated message behind.
+
+fsyncs are group committed: the first writer to commit waits up to `window` seconds for other writers that are
+still in progress (eg. concurrent LMTP deliveries), then flushes the whole batch, syncing every file once and
+every touched directory once. A lone writer never waits.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+TMP_SUFFIX = '.tmp'
+DEFAULT_WINDOW = 0.005
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Commit(object):
+
+    def __init__(self, files, rename=None, directory=None):
+        self.files = files
+        self.rename = rename
+        self.directory = directory
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+
+    def __init__(self, window=DEFAULT_WINDOW, fsync=True):
+        self.window = window
+        self.fsync = fsync
+        self.condition = threading.Condition()
+        self.active = 0
+        self.pending = []
+        self.collecting = False
+
+    def begin(self):
+        """Register a write in progress, a collecting leader will wait for it to commit"""
+        with self.condition:
+            self.active += 1
+
+    def abandon(self):
+        """Unregister a write started with `begin` that will not be committed"""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def commit(self, files, rename=None, directory=None):
+        """Durably commit the open file objects in `files`, then optionally rename (src, dst) and sync `directory`.
+        Must be paired with a previous `begin`. Blocks until the batch containing this commit is flushed."""
+        entry = _Commit(files, rename=rename, directory=directory)
+        with self.condition:
+            self.active -= 1
+            self.pending.append(entry)
+            self.condition.notify_all()
+            leader = not self.collecting
+            if leader:
+                self.collecting = True
+                deadline = time.monotonic() + self.window
+                while self.active > 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, self.pending = self.pending, []
+                self.collecting = False
+
+        if leader:
+            self.flush(batch)
+        entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+
+    def flush(self, batch):
+        directories = {}
+        try:
+            for entry in batch:
+                try:
+                    if self.fsync:
+                        for fd in entry.files:
+                            fd.flush()
+                            os.fsync(fd.fileno())
+                    if entry.rename is not None:
+                        os.rename(*entry.rename)
+                    if entry.directory is not None:
+                        directories.setdefault(entry.directory, []).append(entry)
+                except OSError as e:
+                    entry.error = e
+            if self.fsync:
+                for directory, entries in directories.items():
+                    try:
+                        fsync_dir(directory)
+                    except OSError as e:
+                        for entry in entries:
+                            entry.error = e
+        finally:
+            for entry in batch:
+                entry.done.set()
+
+    @contextmanager
+    def atomic_write(self, path):
+        """Open a temporary file for writing that is durably renamed to `path` when the block exits successfully"""
+        tmp_path = '{}.{}.{}{}'.format(path, os.getpid(), threading.get_ident(), TMP_SUFFIX)
+        try:
+            with open(tmp_path, 'wb') as fd:
+                self.begin()
+                try:
+                    yield fd
+                except BaseException:
+                    self.abandon()
+                    raise
+                self.commit([fd], rename=(tmp_path, path), directory=os.path.dirname(path))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
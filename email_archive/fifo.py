@@ -1,50 +1,820 @@
+import time
+import random
 import logging
 
+import redis
+
+from .config import Configuration, ConfigurationError
+
 
 logger = logging.getLogger(__name__)
 
+LEASE_TIMEOUT = 300
+# Elasticsearch client defaults, see get_lease_timeout
+ES_TIMEOUT = 10
+ES_MAX_RETRIES = 3
+DEFAULT_SIZE_CLASS = 'default'
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+MAX_ATTEMPTS = 5
+ERROR_MESSAGE_LIMIT = 1000
+DEAD_LETTER_BATCH = 1000
+
+
+# Pops up to `count` items from `queues`. Each queue is first served up to its quota, then the remaining slots are
+# filled from the queues in order. Returns the items, the number taken from each queue, whether it was drained and
+# the queue (index) each item came from. `pop(queue)` performs the actual pop of a single item.
+TAKE_SCRIPT = """
+local items = {}
+local taken = {}
+local drained = {}
+local sources = {}
+local function take(i, limit)
+    while taken[i] < limit and #items < count do
+        local item = pop(queues[i])
+        if not item then
+            drained[i] = 1
+            return
+        end
+        items[#items + 1] = item
+        sources[#items] = i
+        taken[i] = taken[i] + 1
+    end
+end
+for i = 1, #queues do
+    taken[i] = 0
+    drained[i] = 0
+    take(i, quotas[i])
+end
+for i = 1, #queues do
+    if drained[i] == 0 then
+        take(i, count)
+    end
+end
+"""
+
+# KEYS: queues, ARGV: count, quota of each queue
+POP_MANY_SCRIPT = """
+local count = tonumber(ARGV[1])
+local queues = KEYS
+local quotas = {}
+for i = 1, #queues do
+    quotas[i] = tonumber(ARGV[i + 1])
+end
+local function pop(queue)
+    return redis.call('RPOP', queue)
+end
+""" + TAKE_SCRIPT + """
+return {items, taken, drained, sources}
+"""
+
+# Reliable variant of POP_MANY_SCRIPT: items are moved to the consumer's processing list and leased until ARGV[2]
+# KEYS: consumers set, processing list, leases zset, origin hash, queues...
+# ARGV: count, lease deadline, consumer, quota of each queue
+RELIABLE_POP_MANY_SCRIPT = """
+local count = tonumber(ARGV[1])
+local queues = {}
+local quotas = {}
+for i = 5, #KEYS do
+    queues[#queues + 1] = KEYS[i]
+    quotas[#quotas + 1] = tonumber(ARGV[i - 1])
+end
+local function pop(queue)
+    local item = redis.call('RPOPLPUSH', queue, KEYS[2])
+    if item then
+        redis.call('ZADD', KEYS[3], ARGV[2], item)
+        redis.call('HSET', KEYS[4], item, queue)
+    end
+    return item
+end
+""" + TAKE_SCRIPT + """
+if #items > 0 then
+    redis.call('SADD', KEYS[1], ARGV[3])
+end
+return {items, taken, drained, sources}
+"""
+
+# Count a failed attempt of each item. Permanent failures and items attempted ARGV[4] times are added to the
+# dead letter stream along with their error, the others are scheduled for another attempt after an exponential
+# backoff with jitter, to be pushed to their destination queue when due.
+# KEYS: retry zset, attempts hash, retry destination hash, dead letter stream
+# ARGV: now, base delay, max delay, max attempts, size class,
+#       then for each item: item, destination queue, jitter in [0, 1), permanent (0 or 1), error type, error message
+FAIL_SCRIPT = """
+local dead = {}
+for i = 6, #ARGV, 6 do
+    local item = ARGV[i]
+    local attempts = redis.call('HINCRBY', KEYS[2], item, 1)
+    if ARGV[i + 3] == '1' or attempts >= tonumber(ARGV[4]) then
+        redis.call('HDEL', KEYS[2], item)
+        redis.call('XADD', KEYS[4], '*', 'path', item, 'type', ARGV[i + 4], 'message', ARGV[i + 5],
+                   'attempts', attempts, 'size_class', ARGV[5])
+        dead[#dead + 1] = item
+    else
+        local delay = math.min(tonumber(ARGV[2]) * 2 ^ (attempts - 1), tonumber(ARGV[3]))
+        redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + delay * (0.5 + tonumber(ARGV[i + 2]) / 2), item)
+        redis.call('HSET', KEYS[3], item, ARGV[i + 1])
+    end
+end
+return dead
+"""
+
+# Move up to ARGV[1] items of the failed list used by earlier versions to the dead letter stream
+# KEYS: failed list, dead letter stream
+MIGRATE_FAILED_SCRIPT = """
+local moved = 0
+while moved < tonumber(ARGV[1]) do
+    local item = redis.call('RPOP', KEYS[1])
+    if not item then
+        break
+    end
+    redis.call('XADD', KEYS[2], '*', 'path', item, 'type', '', 'message', '', 'attempts', 0, 'size_class', '')
+    moved = moved + 1
+end
+return moved
+"""
+
+# Push up to ARGV[2] retries due before ARGV[1] to the front of their destination queue, a list or a stream
+# KEYS: retry zset, retry destination hash, ARGV: now, limit, 'list' or 'stream'
+PROMOTE_DUE_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(items) do
+    local destination = redis.call('HGET', KEYS[2], item)
+    redis.call('ZREM', KEYS[1], item)
+    redis.call('HDEL', KEYS[2], item)
+    if destination then
+        if ARGV[3] == 'stream' then
+            redis.call('XADD', destination, '*', 'path', item)
+        else
+            redis.call('RPUSH', destination, item)
+        end
+    end
+end
+return #items
+"""
+
+# Return the items of consumer ARGV[2] whose lease expired before ARGV[1] to the front of the queue they came from.
+# Items from a queue not passed in KEYS, popped again since the caller read the origins, are left for the next call.
+# KEYS: consumers set, processing list, leases zset, origin hash, queues the items came from
+# ARGV: now, consumer
+REQUEUE_EXPIRED_SCRIPT = """
+local sources = {}
+for i = 5, #KEYS do
+    sources[KEYS[i]] = true
+end
+local requeued = 0
+for _, item in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])) do
+    local source = redis.call('HGET', KEYS[4], item)
+    if not source or sources[source] then
+        redis.call('LREM', KEYS[2], 1, item)
+        redis.call('ZREM', KEYS[3], item)
+        redis.call('HDEL', KEYS[4], item)
+        if source then
+            redis.call('RPUSH', source, item)
+            requeued = requeued + 1
+        end
+    end
+end
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    redis.call('DEL', KEYS[2], KEYS[4])
+    redis.call('SREM', KEYS[1], ARGV[2])
+end
+return requeued
+"""
+
+
+class DeficitScheduler(object):
+    """
+    Deficit round robin across priorities. Every pop of `count` items credits each priority with its weighted
+    share of `count`, and each priority is served up to its accumulated credit before any remaining slots go to
+    the highest priority that still has items. A priority whose queue runs empty forfeits its credit, so an idle
+    priority cannot save up a burst.
+
+    `min_share` maps priorities to the fraction of pops they are guaranteed while backlogged, raising their
+    weight as needed. Priorities without a weight default to 1.
+    """
+
+    def __init__(self, priorities, weights=None, min_share=None):
+        weights = dict((str(k), float(v)) for k, v in (weights or {}).items())
+        weights = dict((str(p), weights.get(str(p), 1.0)) for p in priorities)
+        for priority, share in (min_share or {}).items():
+            priority = str(priority)
+            if priority not in weights:
+                continue
+            if not 0 < share < 1:
+                raise ConfigurationError('min_share of priority {} must be between 0 and 1'.format(priority))
+            others = sum(w for p, w in weights.items() if p != priority)
+            weights[priority] = max(weights[priority], others * share / (1 - share))
+
+        total = sum(weights.values())
+        self.shares = [weights[str(p)] / total for p in priorities]
+        self.deficits = [0.0] * len(self.shares)
+
+    def quotas(self, count):
+        """Credit a pop of `count` items, returning how many each priority may take first"""
+        for i, share in enumerate(self.shares):
+            self.deficits[i] += count * share
+        return [int(x) for x in self.deficits]
+
+    def update(self, taken, drained):
+        """Charge the items taken from each priority. Slots left over by other priorities are free."""
+        for i, (count, empty) in enumerate(zip(taken, drained)):
+            self.deficits[i] = 0.0 if empty else max(self.deficits[i] - count, 0.0)
+
 
 class FIFOQueue(object):
+    """
+    Priority queue of archive paths, one Redis list per priority.
+
+    If `consumer` is given the queue is reliable: popped items are moved to a per-consumer processing list and
+    leased for `lease_timeout` seconds. They must be acknowledged with `ack` once handled, or their lease extended
+    with `renew` while they are still being worked on, and `requeue_expired` returns the items of consumers that
+    died (or stalled) past their lease to the queue.
+
+    Priorities are served strictly in order unless a `scheduler` (see DeficitScheduler) shares batch pops
+    between them.
+
+    Items that fail transiently are retried by `fail` after an exponential backoff starting at `retry_delay`
+    seconds, in the queue they were popped from, until they have been attempted `max_attempts` times and are dead
+    lettered (see DeadLetters).
+
+    `size_classes` maps class names to a minimum item size in bytes. Items pushed with a size are routed to the
+    sub-queues of the largest class they reach, anything smaller stays in the default class. A queue only pops
+    from the sub-queues of its own `size_class` (None for the default class).
+    """
+
+    # How due retries are pushed back, see PROMOTE_DUE_SCRIPT
+    retry_mode = 'list'
 
-    def __init__(self, queue_name, connection, priorities=None):
+    def __init__(self, queue_name, connection, priorities=None, consumer=None, lease_timeout=LEASE_TIMEOUT,
+                 scheduler=None, size_classes=None, size_class=None, retry_delay=RETRY_DELAY,
+                 max_retry_delay=MAX_RETRY_DELAY, max_attempts=MAX_ATTEMPTS):
         self.queue_name = queue_name
         self.connection = connection
+        self.consumer = consumer
+        self.lease_timeout = lease_timeout
+        self.scheduler = scheduler
+        self.size_classes = sorted((size_classes or {}).items(), key=lambda x: x[1])
+        self.size_class = size_class
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        # Queue each popped item came from, until acknowledged, to retry it there
+        self.sources = {}
 
         self.priorities = (1, 2, 3)
         if priorities is not None:
             self.priorities = priorities
         self.configure_queues()
+        self._pop_many = self.connection.register_script(POP_MANY_SCRIPT)
+        self._reliable_pop_many = self.connection.register_script(RELIABLE_POP_MANY_SCRIPT)
+        self._requeue_expired = self.connection.register_script(REQUEUE_EXPIRED_SCRIPT)
+        self._fail = self.connection.register_script(FAIL_SCRIPT)
+        self._promote_due = self.connection.register_script(PROMOTE_DUE_SCRIPT)
         logging.debug('Setup {} with queues {}'.format(self.__class__.__name__, self.queues))
 
     def configure_queues(self):
-        self.queues = [self.get_queue(p) for p in self.priorities]
+        self.queues = [self.get_queue(self.lane(p, self.size_class)) for p in self.priorities]
 
     def get_queue(self, priority):
         return '{}:{}'.format(self.queue_name, priority)
 
-    def push(self, item, priority=2):
-        self.queue_length = self.connection.lpush(self.get_queue(priority), item)
+    def lane(self, priority, size_class=None):
+        """Key suffix of the sub-queue for `priority` in `size_class`. The default class uses the plain priority
+        queue, as do non-numeric queues such as `failed`"""
+        if size_class is None or not str(priority).isdigit():
+            return priority
+        return '{}:{}'.format(priority, size_class)
+
+    def classify(self, size):
+        """Return the size class for an item of `size` bytes, None for the default class"""
+        size_class = None
+        if size is not None:
+            for name, threshold in self.size_classes:
+                if size >= threshold:
+                    size_class = name
+        return size_class
+
+    def push(self, item, priority=2, pipeline=None, size=None, size_class=None):
+        """Push `item` onto the queue for `priority`, in `size_class` or the size class of `size` if given. If
+        `pipeline` is given the command is only buffered onto it, letting callers send extra bookkeeping in the
+        same round trip"""
+        lane = self.lane(priority, size_class or self.classify(size))
+        return (pipeline or self.connection).lpush(self.get_queue(lane), item)
+
+    def push_tracked(self, item, priority=2, dedup_key=None, dedup_ttl=86400, size=None):
+        """Push `item` along with its enqueue timestamp and an optional dedup marker in a single
+        round trip. Returns False if `dedup_key` had already been seen within `dedup_ttl` seconds"""
+        pipeline = self.connection.pipeline(transaction=False)
+        self.push(item, priority=priority, pipeline=pipeline, size=size)
+        pipeline.hset(self.get_queue('enqueued'), item, time.time())
+        if dedup_key is not None:
+            pipeline.set(self.get_queue('dedup:{}'.format(dedup_key)), item, nx=True, ex=dedup_ttl)
+        result = pipeline.execute()
+        return dedup_key is None or bool(result[2])
+
+    def mark_done(self, item):
+        """Clear enqueue bookkeeping for `item`, returning the time it spent queued in seconds
+        or None if it was not pushed with `push_tracked`"""
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.hget(self.get_queue('enqueued'), item)
+        pipeline.hdel(self.get_queue('enqueued'), item)
+        enqueued, _ = pipeline.execute()
+        if enqueued is None:
+            return None
+        return time.time() - float(enqueued)
+
+    def mark_done_many(self, items):
+        """Clear enqueue bookkeeping for all of `items` in one round trip, returning the time each spent queued
+        (or None) as with `mark_done`"""
+        if not items:
+            return []
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.hmget(self.get_queue('enqueued'), items)
+        pipeline.hdel(self.get_queue('enqueued'), *items)
+        enqueued, _ = pipeline.execute()
+        now = time.time()
+        return [None if x is None else now - float(x) for x in enqueued]
 
     def pop(self, timeout=None):
         if timeout is None:
             for queue in self.queues:
-                item = self.connection.rpop(self.queue_name)
+                item = self.connection.rpop(queue)
                 if item is not None:
+                    self.sources[item] = queue
                     return item
             return None
         else:
             item = self.connection.brpop(self.queues, timeout)
             if item:
+                self.sources[item[1]] = item[0]
                 item = item[1]
         return item
 
+    @property
+    def reliable(self):
+        return self.consumer is not None
+
+    def pop_many(self, count, timeout=None):
+        """Pop up to `count` items across the priority queues in a single round trip. If none are available and
+        `timeout` is given, block up to `timeout` seconds for one (except in reliable mode, which cannot block)"""
+        if timeout:
+            items = self.pop_many(count)
+            if items or self.reliable:
+                return items
+            item = self.pop(timeout=timeout)
+            return [item] if item else []
+
+        return self.pop_many_result(self.pop_many_command(count))
+
+    def quotas(self, count):
+        if self.scheduler is None:
+            return [0] * len(self.queues)
+        return self.scheduler.quotas(count)
+
+    def pop_many_command(self, count):
+        """Run the non-blocking pop of `pop_many`. The reply, which is awaitable on an asyncio connection,
+        must be passed to `pop_many_result`"""
+        if self.reliable:
+            keys = [self.get_queue('consumers')] + self.consumer_keys(self.consumer) + self.queues
+            args = [count, time.time() + self.lease_timeout, self.consumer] + self.quotas(count)
+            return self._reliable_pop_many(keys=keys, args=args)
+        return self._pop_many(keys=self.queues, args=[count] + self.quotas(count))
+
+    def pop_many_result(self, reply):
+        items, taken, drained, sources = reply
+        for item, source in zip(items, sources):
+            self.sources[item] = self.queues[source - 1]
+        if self.scheduler is not None:
+            self.scheduler.update(taken, drained)
+        return items
+
+    def consumer_keys(self, consumer):
+        """Keys of the processing list, leases and origin hash of `consumer`"""
+        return [self.get_queue('{}:{}'.format(x, consumer)) for x in ('processing', 'leases', 'origin')]
+
+    def ack(self, items, pipeline=None):
+        """Acknowledge reliably popped `items` as handled, releasing their leases"""
+        for item in items:
+            self.sources.pop(item, None)
+        if not self.reliable or not items:
+            return
+        processing, leases, origin = self.consumer_keys(self.consumer)
+        execute = pipeline is None
+        if execute:
+            pipeline = self.connection.pipeline(transaction=False)
+        for item in items:
+            pipeline.lrem(processing, 1, item)
+        pipeline.zrem(leases, *items)
+        pipeline.hdel(origin, *items)
+        if execute:
+            return pipeline.execute()
+
+    def in_flight(self):
+        """Yield the items reliably popped by any consumer that have not been acknowledged yet"""
+        for consumer in self.connection.smembers(self.get_queue('consumers')):
+            for item, _ in self.connection.hscan_iter(self.consumer_keys(consumer.decode('utf8'))[2]):
+                yield item
+
+    def renew(self, items):
+        """Extend the leases of reliably popped `items` that are still held to `lease_timeout` seconds from now.
+        Called before each bulk request, so a batch that took long to parse is not requeued while in flight."""
+        if not self.reliable or not items:
+            return
+        deadline = time.time() + self.lease_timeout
+        return self.connection.zadd(self.consumer_keys(self.consumer)[1], dict((x, deadline) for x in items), xx=True)
+
+    def requeue_expired(self):
+        """Return items whose lease has expired, from any consumer, to the front of their queue.
+        Returns the number of items requeued."""
+        requeued = 0
+        for consumer in self.connection.smembers(self.get_queue('consumers')):
+            consumer = consumer.decode('utf8')
+            sources = self.connection.hvals(self.consumer_keys(consumer)[2])
+            requeued += self.requeue_expired_command(consumer, sources)
+        return requeued
+
+    def requeue_expired_command(self, consumer, sources):
+        """Requeue the expired items of `consumer`, whose origin hash holds the queues `sources`. The reply is
+        awaitable on an asyncio connection."""
+        keys = [self.get_queue('consumers')] + self.consumer_keys(consumer) + sorted(set(sources))
+        return self._requeue_expired(keys=keys, args=[time.time(), consumer])
+
+    def source(self, item):
+        """The queue `item` was popped from, this consumer's highest priority queue if unknown"""
+        if not isinstance(item, bytes):
+            item = item.encode('utf8')
+        return self.sources.get(item, self.queues[0])
+
+    def fail(self, failures):
+        """Record failed items, a list of (item, error type, error message, transient). Transient failures are
+        scheduled for another attempt at the front of the queue they were popped from, permanent ones and items out
+        of attempts are dead lettered. Returns the items dead lettered."""
+        if not failures:
+            return []
+        keys = [self.get_queue('retry'), self.get_queue('attempts'), self.get_queue('retry-destination'),
+                self.dead_letters.key]
+        args = [time.time(), self.retry_delay, self.max_retry_delay, self.max_attempts, self.size_class or '']
+        for item, error_type, message, transient in failures:
+            args.extend([item, self.source(item), random.random(), 0 if transient else 1, error_type or '',
+                         message[:ERROR_MESSAGE_LIMIT]])
+        return self._fail(keys=keys, args=args)
+
+    @property
+    def dead_letters(self):
+        return DeadLetters(self)
+
+    def clear_attempts(self, items, pipeline=None):
+        """Forget the failed attempts of `items` once they have been handled"""
+        if items:
+            return (pipeline or self.connection).hdel(self.get_queue('attempts'), *items)
+
+    def promote_due(self, limit=1000):
+        """Push up to `limit` retries that are due back to their queue. Returns the number of items pushed."""
+        return self._promote_due(keys=[self.get_queue('retry'), self.get_queue('retry-destination')],
+                                 args=[time.time(), limit, self.retry_mode])
+
     def queue_length(self, priority=None):
         if priority is None:
             return sum([self.connection.llen(q) for q in self.queues])
+        elif priority == 'retry':
+            return self.connection.zcard(self.get_queue('retry'))
+        elif priority == 'failed':
+            return self.dead_letters.length()
         else:
-            return self.connection.llen(self.get_queue(priority))
+            return self.connection.llen(self.get_queue(self.lane(priority, self.size_class)))
 
     def __repr__(self):
         return '<{} "{}" length={}>'.format(self.__class__.__name__,
                                             self.queue_name,
                                             self.queue_length())
+
+
+class DeadLetters(object):
+    """
+    Items that failed permanently or ran out of attempts, kept in a stream with their error type, message,
+    attempt count and size class. Entry ids record when each item was dead lettered.
+
+    Entries are scanned in bounded batches, optionally filtered by error type, time and path prefix, so
+    retrying or purging any number of them uses constant memory. Each batch is pushed or deleted in a
+    single transaction, so an interrupted retry neither loses nor duplicates items.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.connection = queue.connection
+        self.key = queue.get_queue('dead-letters')
+        self.legacy_key = queue.get_queue('failed')
+
+    def length(self):
+        return self.connection.xlen(self.key) + self.connection.llen(self.legacy_key)
+
+    def migrate(self, batch_size=DEAD_LETTER_BATCH):
+        """Move items of the plain failed list used by earlier versions into the stream, without error details.
+        Returns the number of items moved."""
+        script = self.connection.register_script(MIGRATE_FAILED_SCRIPT)
+        moved = 0
+        while True:
+            count = script(keys=[self.legacy_key, self.key], args=[batch_size])
+            moved += count
+            if count < batch_size:
+                return moved
+
+    def scan(self, error_type=None, since=None, path_prefix=None, batch_size=DEAD_LETTER_BATCH):
+        """Yield lists of (entry id, fields) matching the filters, oldest first. `since` is a unix timestamp."""
+        start = '{}-0'.format(int(since * 1000)) if since else '-'
+        while True:
+            entries = self.connection.xrange(self.key, min=start, count=batch_size)
+            if not entries:
+                return
+            start = '(' + entries[-1][0].decode('ascii')
+            matched = [(entry_id, dict((k.decode('utf8'), v.decode('utf8')) for k, v in fields.items()))
+                       for entry_id, fields in entries]
+            if error_type is not None:
+                matched = [x for x in matched if x[1].get('type') == error_type]
+            if path_prefix is not None:
+                matched = [x for x in matched if x[1].get('path', '').startswith(path_prefix)]
+            if matched:
+                yield matched
+            if len(entries) < batch_size:
+                return
+
+    def retry(self, priority=1, **filters):
+        """Push matching items back to the queue at `priority`, in their original size class. Returns the number
+        of items retried."""
+        retried = 0
+        for batch in self.scan(**filters):
+            pipeline = self.connection.pipeline(transaction=True)
+            for entry_id, fields in batch:
+                self.queue.push(fields['path'], priority=priority, pipeline=pipeline,
+                                size_class=fields.get('size_class') or None)
+            pipeline.xdel(self.key, *[entry_id for entry_id, _ in batch])
+            pipeline.execute()
+            retried += len(batch)
+        return retried
+
+    def purge(self, **filters):
+        """Delete matching items. Returns the number of items deleted."""
+        if not any(x is not None for x in filters.values()):
+            pipeline = self.connection.pipeline(transaction=True)
+            pipeline.xlen(self.key)
+            pipeline.delete(self.key)
+            return pipeline.execute()[0]
+        purged = 0
+        for batch in self.scan(**filters):
+            purged += self.connection.xdel(self.key, *[entry_id for entry_id, _ in batch])
+        return purged
+
+
+class StreamQueue(FIFOQueue):
+    """
+    FIFOQueue compatible queue backed by one Redis Stream per priority, consumed through a consumer group.
+    Every consumer has its own pending entries list, so work held by a dead consumer is visible and is
+    claimed by live consumers once idle for `lease_timeout` seconds. Acknowledged entries are trimmed.
+
+    Non-numeric "priorities", such as the failed list, remain plain lists.
+    """
+
+    CLAIM_COUNT = 1000
+    CONSUMER_EXPIRY = 86400
+    retry_mode = 'stream'
+
+    def __init__(self, queue_name, connection, group='indexers', **kwargs):
+        self.group = group
+        self._pending = {}
+        self._claimed = []
+        self._groups_created = False
+        super(StreamQueue, self).__init__(queue_name, connection, **kwargs)
+
+    def configure_queues(self):
+        self.queues = [self.get_stream(self.lane(p, self.size_class)) for p in self.priorities]
+
+    def get_stream(self, priority):
+        return '{}:stream:{}'.format(self.queue_name, priority)
+
+    def ensure_groups(self):
+        if self._groups_created:
+            return
+        for stream in self.queues:
+            try:
+                # Start from the beginning, entries may have been added before the first consumer started
+                self.connection.xgroup_create(stream, self.group, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        self._groups_created = True
+
+    def push(self, item, priority=2, pipeline=None, size=None, size_class=None):
+        if not str(priority).isdigit():
+            return super(StreamQueue, self).push(item, priority=priority, pipeline=pipeline)
+        lane = self.lane(priority, size_class or self.classify(size))
+        return (pipeline or self.connection).xadd(self.get_stream(lane), {'path': item})
+
+    def _receive(self, response):
+        items = []
+        for stream, entries in response or []:
+            for entry_id, fields in entries:
+                if not fields:
+                    # Trimmed while pending
+                    self.connection.xack(stream, self.group, entry_id)
+                    continue
+                item = fields[b'path']
+                self._pending.setdefault(item, []).append((stream, entry_id))
+                items.append(item)
+        return items
+
+    def pop_many(self, count, timeout=None):
+        self.ensure_groups()
+        items = []
+        while self._claimed and len(items) < count:
+            stream, entry_id, fields = self._claimed.pop()
+            items.extend(self._receive([(stream, [(entry_id, fields)])]))
+
+        taken = [0] * len(self.queues)
+        drained = [False] * len(self.queues)
+        # Serve each stream up to its quota first, then fill the remaining slots in priority order
+        for limits in (self.quotas(count - len(items)), [count] * len(self.queues)):
+            for i, stream in enumerate(self.queues):
+                wanted = min(limits[i] - taken[i], count - len(items))
+                if drained[i] or wanted <= 0:
+                    continue
+                response = self.connection.xreadgroup(self.group, self.consumer, {stream: '>'}, count=wanted)
+                received = self._receive(response)
+                items.extend(received)
+                taken[i] += len(received)
+                drained[i] = len(received) < wanted
+        if self.scheduler is not None:
+            self.scheduler.update(taken, drained)
+
+        if not items and timeout:
+            response = self.connection.xreadgroup(self.group, self.consumer, dict((x, '>') for x in self.queues),
+                                                  count=1, block=int(timeout * 1000))
+            items = self._receive(response)
+        return items
+
+    def pop(self, timeout=None):
+        items = self.pop_many(1, timeout=timeout)
+        return items[0] if items else None
+
+    def source(self, item):
+        if not isinstance(item, bytes):
+            item = item.encode('utf8')
+        entries = self._pending.get(item)
+        return entries[0][0] if entries else self.queues[0]
+
+    def ack(self, items, pipeline=None):
+        if not items:
+            return
+        execute = pipeline is None
+        if execute:
+            pipeline = self.connection.pipeline(transaction=False)
+        for item in items:
+            if not isinstance(item, bytes):
+                item = item.encode('utf8')
+            entries = self._pending.get(item)
+            if not entries:
+                continue
+            stream, entry_id = entries.pop(0)
+            if not entries:
+                del self._pending[item]
+            pipeline.xack(stream, self.group, entry_id)
+        if execute:
+            return pipeline.execute()
+
+    def renew(self, items):
+        """Reset the idle time of the pending entries of `items`, so other consumers do not claim them while they
+        are still being worked on"""
+        entries = {}
+        for item in items:
+            if not isinstance(item, bytes):
+                item = item.encode('utf8')
+            for stream, entry_id in self._pending.get(item, []):
+                entries.setdefault(stream, []).append(entry_id)
+        for stream, entry_ids in entries.items():
+            self.connection.xclaim(stream, self.group, self.consumer, 0, entry_ids, justid=True)
+
+    def in_flight(self):
+        """Yield the items of entries delivered to any consumer of the group that have not been acknowledged yet"""
+        for stream in self.queues:
+            if not self.connection.exists(stream):
+                continue
+            start = '-'
+            while True:
+                pending = self.connection.xpending_range(stream, self.group, min=start, max='+',
+                                                         count=self.CLAIM_COUNT)
+                for entry in pending:
+                    for _, fields in self.connection.xrange(stream, min=entry['message_id'],
+                                                            max=entry['message_id']):
+                        if fields:
+                            yield fields[b'path']
+                if len(pending) < self.CLAIM_COUNT:
+                    break
+                start = '(' + pending[-1]['message_id'].decode('ascii')
+
+    def requeue_expired(self):
+        """Claim entries idle in other consumers' pending lists for longer than the lease, to be returned by the
+        next pops. Also trims acknowledged entries and forgets long idle consumers. Returns the number claimed."""
+        self.ensure_groups()
+        claimed = 0
+        for stream in self.queues:
+            response = self.connection.xautoclaim(stream, self.group, self.consumer,
+                                                  min_idle_time=int(self.lease_timeout * 1000),
+                                                  count=self.CLAIM_COUNT)
+            for entry_id, fields in response[1]:
+                self._claimed.append((stream, entry_id, fields))
+                claimed += 1
+            self.trim(stream)
+        return claimed
+
+    def trim(self, stream):
+        """Remove entries every group has acknowledged, and consumers that have been idle with nothing pending"""
+        min_id = None
+        for group in self.connection.xinfo_groups(stream):
+            pending = self.connection.xpending(stream, group['name'])
+            oldest = pending['min'] if pending['pending'] else group['last-delivered-id']
+            if min_id is None or _stream_id(oldest) < _stream_id(min_id):
+                min_id = oldest
+        if min_id is not None:
+            self.connection.xtrim(stream, minid=min_id, approximate=True)
+
+        for consumer in self.connection.xinfo_consumers(stream, self.group):
+            name = consumer['name'].decode('utf8') if isinstance(consumer['name'], bytes) else consumer['name']
+            if name != self.consumer and consumer['pending'] == 0 and consumer['idle'] > self.CONSUMER_EXPIRY * 1000:
+                self.connection.xgroup_delconsumer(stream, self.group, name)
+
+    def queue_length(self, priority=None):
+        """Number of entries not yet delivered to a consumer"""
+        if priority is None:
+            return sum([self.queue_length(p) for p in self.priorities])
+        if not str(priority).isdigit():
+            return super(StreamQueue, self).queue_length(priority)
+        stream = self.get_stream(self.lane(priority, self.size_class))
+        for group in self.connection.xinfo_groups(stream) if self.connection.exists(stream) else []:
+            if group['name'] in (self.group, self.group.encode('utf8')) and group.get('lag') is not None:
+                return group['lag']
+        return self.connection.xlen(stream)
+
+    def consumer_info(self):
+        """Return (priority, consumer, pending entries, idle seconds) for every consumer of every stream"""
+        info = []
+        for priority, stream in zip(self.priorities, self.queues):
+            if not self.connection.exists(stream):
+                continue
+            for consumer in self.connection.xinfo_consumers(stream, self.group):
+                name = consumer['name'].decode('utf8') if isinstance(consumer['name'], bytes) else consumer['name']
+                info.append((priority, name, consumer['pending'], consumer['idle'] / 1000.0))
+        return info
+
+
+def _stream_id(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('ascii')
+    milliseconds, _, sequence = entry_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+BACKENDS = {
+    'lists': FIFOQueue,
+    'streams': StreamQueue
+}
+
+
+def get_lease_timeout():
+    """The configured lease timeout, raised if needed to cover a bulk request sent twice (see Indexer.index_bulk)
+    with all of its retries at the Elasticsearch client's timeout. Leases are renewed before each bulk request."""
+    lease_timeout = Configuration.REDIS.get('lease_timeout', LEASE_TIMEOUT)
+    elastic = Configuration.ELASTIC or {}
+    minimum = 2 * elastic.get('timeout', ES_TIMEOUT) * (elastic.get('max_retries', ES_MAX_RETRIES) + 1)
+    if lease_timeout < minimum:
+        logger.warning('Raising lease_timeout from {} to {} seconds, the longest a bulk request can take'.format(
+            lease_timeout, minimum))
+        lease_timeout = minimum
+    return lease_timeout
+
+
+def open_queue(connection, priorities=None, consumer=None, size_class=None):
+    """Open the queue backend selected in configuration. `consumer` names the calling process for backends and
+    modes that track in-flight items; producers can omit it. Consumers pop from the sub-queues of `size_class`."""
+    config = Configuration.REDIS
+    backend = config.get('backend', 'lists')
+    if backend not in BACKENDS:
+        raise ConfigurationError('Unknown queue backend {}, expected one of {}'.format(backend, ', '.join(BACKENDS)))
+    size_classes = config.get('size_classes') or {}
+    if size_class is not None and size_class not in size_classes:
+        raise ConfigurationError('Unknown size class {}'.format(size_class))
+
+    kwargs = dict(priorities=priorities, size_classes=size_classes, size_class=size_class,
+                  retry_delay=config.get('retry_delay', RETRY_DELAY),
+                  max_retry_delay=config.get('max_retry_delay', MAX_RETRY_DELAY),
+                  max_attempts=config.get('max_attempts', MAX_ATTEMPTS))
+    if backend == 'streams':
+        kwargs['group'] = config.get('group', 'indexers')
+    elif not config.get('reliable'):
+        consumer = None
+    # Only consumers hold leases
+    kwargs['lease_timeout'] = get_lease_timeout() if consumer is not None else LEASE_TIMEOUT
+    queue = BACKENDS[backend](config['queue'], connection, consumer=consumer, **kwargs)
+    if config.get('weights') or config.get('min_share'):
+        queue.scheduler = DeficitScheduler(queue.priorities, weights=config.get('weights'),
+                                           min_share=config.get('min_share'))
+    return queue
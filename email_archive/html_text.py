@@ -0,0 +1,46 @@
+"""
+HTML to text extraction for indexing message bodies. A few regular expression passes over the markup, no
+document tree: comments, <script> and <style> elements (with their contents) are dropped, block level tags become
+whitespace and other tags are removed, then character references are decoded and runs of whitespace collapsed to
+a single space.
+
+Apart from whitespace the text is the same as that of `bleach.clean(html, tags=[], strip=True)`, which this
+replaces, once its escaped entities are decoded, except that script and style contents are not indexed and
+references missing their semicolon (&amp, &copy) are decoded as browsers do (see benchmarks/html_text.py).
+"""
+import re
+from html import unescape
+from itertools import groupby
+
+
+# Comments and raw text elements, up to their end or the end of the document when unterminated
+SKIP_RE = re.compile(r'<!--.*?(?:-->|\Z)|<(script|style)\b.*?(?:</\1\s*>|\Z)', re.S | re.I)
+# Tags, allowing > within quoted attribute values, and declarations or processing instructions. Tags and quotes left
+# open run to the end of the document, so a match never fails once started and never backtracks.
+TAG_ATTRIBUTES = r'''[^>=]*(?:=\s*(?:"[^"]*"?|'[^']*'?)?[^>=]*)*(?:>|\Z)'''
+BLOCK_TAGS = ('address', 'article', 'aside', 'blockquote', 'br', 'caption', 'center', 'dd', 'div', 'dl', 'dt',
+              'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header',
+              'hr', 'img', 'li', 'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tbody', 'td', 'tfoot', 'th',
+              'thead', 'title', 'tr', 'ul')
+
+
+def _alternation(words):
+    """Regular expression alternation of `words` grouped by first letter, so each tag is only tried against the
+    names sharing its first letter"""
+    groups = []
+    for first, group in groupby(sorted(words), key=lambda x: x[0]):
+        rest = sorted((x[1:] for x in group), key=len, reverse=True)
+        groups.append('{}(?:{})'.format(first, '|'.join(rest)))
+    return '|'.join(groups)
+
+
+BLOCK_TAG_RE = re.compile(r'</?(?:{})\b{}'.format(_alternation(BLOCK_TAGS), TAG_ATTRIBUTES), re.I)
+TAG_RE = re.compile(r'</?[a-zA-Z]{}|<[!?][^>]*>'.format(TAG_ATTRIBUTES))
+
+
+def html_to_text(html):
+    """Return the text content of the HTML document or fragment `html`, whitespace collapsed"""
+    text = SKIP_RE.sub(' ', html)
+    text = BLOCK_TAG_RE.sub(' ', text)
+    text = TAG_RE.sub('', text)
+    return ' '.join(unescape(text).split())
@@ -2,15 +2,22 @@
 import os
 import sys
 import time
+import signal
+import socket
 import logging
+import functools
 from email.parser import BytesParser
 
 import redis
+import magic
+import chardet
 
 from .config import Configuration
-from .fifo import FIFOQueue
+from . import fifo
 from . import indexer
 from . import message_utils
+from . import supervisor
+from . import backpressure
 
 
 logger = logging.getLogger(__name__)
@@ -18,6 +25,13 @@ logger = logging.getLogger(__name__)
 SLEEP_INTERVAL = 0.5
 RECONNECT_INTERVAL = 5.0
 POP_TIMEOUT = 5
+BATCH_SIZE = 200
+LINGER = 0.5
+LINGER_POLL = 0.05
+REAP_INTERVAL = 30
+PROMOTE_INTERVAL = 1.0
+# Hash of body selection counts, see the body-stats command
+BODY_SELECTION = 'body-selection'
 
 
 _pool = None
@@ -31,57 +45,226 @@ def connect():
     return redis.StrictRedis(connection_pool=_pool)
 
 
-def run(priorities=None):
+def run(priorities=None, batch_size=None, linger=None, workers=None, max_messages=None, size_class=None):
+    config = Configuration.INDEXER
+    if batch_size is None:
+        batch_size = config.get('batch_size', BATCH_SIZE)
+    if linger is None:
+        linger = config.get('linger', LINGER)
+    if workers is None:
+        workers = config.get('workers', 1)
+    if max_messages is None:
+        max_messages = config.get('max_messages_per_child')
+    options = dict(priorities=priorities, batch_size=batch_size, linger=linger, max_messages=max_messages)
+    lanes = get_lanes(workers, size_class)
+
+    if len(lanes) > 1 or workers > 1:
+        def worker(size_class):
+            signal.signal(signal.SIGTERM, request_stop)
+            configure_pool()
+            loop(size_class=size_class, **options)
+
+        pool = supervisor.Supervisor(preload=preload)
+        for lane, count in lanes:
+            pool.add(functools.partial(worker, lane), count)
+        pool.run()
+        return
+    options['size_class'] = lanes[0][0]
+
     configure_pool()
     try:
-        loop(priorities=priorities)
+        loop(**options)
     except KeyboardInterrupt:
         print('\nExiting by user request.\n')
         sys.exit(0)
 
 
-def loop(priorities=None):
+def get_lanes(workers, size_class=None):
+    """Return (size_class, processes) for each lane of workers to run. Without `size_class` every size class
+    gets a lane: `workers` processes for the default class and `indexer.lanes.<class>` (default 1) for others."""
+    if size_class is not None:
+        return [(None if size_class == fifo.DEFAULT_SIZE_CLASS else size_class, workers)]
+    counts = Configuration.INDEXER.get('lanes') or {}
+    lanes = [(None, workers)]
+    for name in Configuration.REDIS.get('size_classes') or {}:
+        lanes.append((name, counts.get(name, 1)))
+    return lanes
+
+
+def preload():
+    """Initialise the heavy parsing dependencies before forking workers, so they are shared copy-on-write"""
+    magic.from_buffer(b'', mime=True)  # Loads the libmagic database
+    chardet.detect(b'')
+
+
+_stop = False
+def request_stop(signum, frame):
+    """Finish the current batch and exit"""
+    global _stop
+    _stop = True
+
+
+def collect_batch(queue, batch_size, linger):
+    """Pop up to `batch_size` items. Blocks up to POP_TIMEOUT for the first item, then waits at most `linger`
+    seconds for the batch to fill"""
+    # There is no blocking reliable pop across several lists, reliable list queues return immediately and the
+    # caller sleeps and polls again
+    batch = queue.pop_many(batch_size, timeout=POP_TIMEOUT)
+    if not batch:
+        return []
+
+    deadline = time.monotonic() + linger
+    while len(batch) < batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        more = queue.pop_many(batch_size - len(batch))
+        if more:
+            batch.extend(more)
+        else:
+            time.sleep(min(LINGER_POLL, remaining))
+    return batch
+
+
+def read_message(message_parser, item):
+    """Load and parse a queued item, a path relative to Configuration.ARCHIVE_DIR"""
+    file_path = os.path.join(Configuration.ARCHIVE_DIR, item)
+    fd = message_utils.gz_open(file_path)
+    try:
+        return message_parser.parsebytes(fd.read())
+    finally:
+        fd.close()
+
+
+def process_batch(idx, queue, message_parser, batch, pressure=None):
+    """Parse and bulk index a batch of queued items and acknowledge it. Items that fail transiently are retried
+    later, others are dead lettered. The outcome of the bulk request is recorded in `pressure`, if given"""
+    failures = []
+    actions = []
+    for item in batch:
+        # Comes from redis as binary
+        item = item.decode('utf8')
+        file_path = os.path.join(Configuration.ARCHIVE_DIR, item)
+        message_path = file_path.replace(Configuration.ARCHIVE_DIR, '').lstrip('/')
+        try:
+            message = read_message(message_parser, item)
+            action = idx.prepare_message(message_path, message)
+        except Exception as e:
+            logger.exception('Unhandled exception processing {}'.format(item))
+            failures.append((item,) + indexer.describe_error(e))
+            continue
+        if action is not None:
+            actions.append((item, action))
+
+    if actions:
+        queue.renew(batch)
+        started = time.monotonic()
+        try:
+            errors = idx.index_bulk([action for _, action in actions])
+        except Exception as e:
+            logger.exception('Unhandled exception bulk indexing {} messages'.format(len(actions)))
+            failures.extend((item,) + indexer.describe_error(e) for item, _ in actions)
+            rejected = len(actions) if indexer.is_rejection(e) else 0
+        else:
+            items = dict((id(action), item) for item, action in actions)
+            for action, error in errors:
+                logger.error('Failed indexing {}: {}'.format(action['_source']['path'], error))
+                failures.append((items[id(action)],) + indexer.describe_error(error))
+            rejected = len([error for _, error in errors if indexer.is_rejection(error)])
+        if pressure is not None:
+            pressure.record(len(actions), time.monotonic() - started, rejected)
+
+    log_failures(failures, queue.fail(failures))
+    pipeline = queue.connection.pipeline(transaction=False)
+    queue.clear_attempts(handled(batch, failures), pipeline=pipeline)
+    queue.ack(batch, pipeline=pipeline)
+    record_body_selection(queue, idx.body_selection, pipeline)
+    pipeline.execute()
+
+
+def handled(batch, failures):
+    """Items of `batch` that are done with, to clear their failed attempts"""
+    failed = set(x[0] for x in failures)
+    return [x for x in batch if x.decode('utf8') not in failed]
+
+
+def record_body_selection(queue, counts, pipeline):
+    """Move the body selection `counts` of a batch (see Indexer.body_selection) to the totals kept in Redis"""
+    key = queue.get_queue(BODY_SELECTION)
+    for name, count in counts.items():
+        pipeline.hincrby(key, name, count)
+    counts.clear()
+
+
+def log_failures(failures, dead):
+    retried = len(failures) - len(dead)
+    if retried:
+        logger.warning('Retrying {} items later'.format(retried))
+    for item in dead:
+        logger.error('Dead lettered {}'.format(item.decode('utf8')))
+
+
+def get_consumer_name():
+    """Name identifying this process' processing list when reliable queueing is enabled"""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def open_queue(conn, priorities=None, size_class=None):
+    consumer = get_consumer_name()
+    if size_class is not None:
+        consumer = '{}:{}'.format(consumer, size_class)
+    return fifo.open_queue(conn, priorities=priorities, consumer=consumer, size_class=size_class)
+
+
+def loop(priorities=None, batch_size=BATCH_SIZE, linger=LINGER, max_messages=None, size_class=None):
+    """Index queued messages of `size_class` until stopped, or until `max_messages` have been processed"""
     message_parser = BytesParser()
     idx = indexer.Indexer()
     conn = None
     queue = None
-    while True:
+    processed = 0
+    pressure = backpressure.from_config(batch_size)
+    next_reap = 0
+    next_promote = 0
+    while not _stop:
         try:
             if not conn:
                 conn = connect()
-                queue = FIFOQueue(Configuration.REDIS['queue'], conn, priorities=priorities)
+                queue = open_queue(conn, priorities=priorities, size_class=size_class)
                 continue  # loop again
 
-            item = queue.pop(timeout=POP_TIMEOUT)
-            if not item:
+            if queue.reliable and time.monotonic() >= next_reap:
+                requeued = queue.requeue_expired()
+                if requeued:
+                    logger.warning('Requeued {} items with expired leases'.format(requeued))
+                next_reap = time.monotonic() + REAP_INTERVAL
+
+            if time.monotonic() >= next_promote:
+                promoted = queue.promote_due()
+                if promoted:
+                    logger.info('Retrying {} items'.format(promoted))
+                next_promote = time.monotonic() + PROMOTE_INTERVAL
+
+            batch = collect_batch(queue, pressure.batch_size, linger)
+            if not batch:
                 # Timeout occurred, loop again
                 time.sleep(SLEEP_INTERVAL)
                 continue
 
-            # Comes from redis as binary
-            item = item.decode('utf8')
-
-            # Fetched item is a path relative to Configuration.ARCHIVE_DIR
-            file_path = os.path.join(Configuration.ARCHIVE_DIR, item)
-            message_path = file_path.replace(Configuration.ARCHIVE_DIR, '').lstrip('/')
-
-            fd = None
-            try:
-                fd = message_utils.gz_open(file_path)
-                message = message_parser.parsebytes(fd.read())
-                idx.process_message(message_path, message)
-            except Exception as e:
-                logger.exception('Unhandled exception processing {}'.format(file_path))
-                queue.push(item, priority='failed')
-                continue
-            finally:
-                if fd:
-                    fd.close()
+            lags = [x for x in queue.mark_done_many(batch) if x is not None]
+            if lags:
+                logger.debug('Dequeued {} items, max lag {:.3f}s'.format(len(batch), max(lags)))
 
+            process_batch(idx, queue, message_parser, batch, pressure=pressure)
+            processed += len(batch)
+            if pressure.delay:
+                time.sleep(pressure.delay)
+            if max_messages and processed >= max_messages:
+                logger.info('Processed {} messages, exiting'.format(processed))
+                return
             continue  # loop again without wait
         except redis.RedisError as e:
             conn = queue = None
             logger.exception('RedisError', e)
             time.sleep(RECONNECT_INTERVAL)
             continue
-
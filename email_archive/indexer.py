@@ -1,32 +1,62 @@
 import hashlib
 import logging
 import quopri
+from collections import Counter
 from functools import wraps
 import mimetypes
 
 import magic
 import chardet
-import bleach
 import elasticsearch
-from elasticsearch.exceptions import NotFoundError
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError, RequestError, TransportError
 
 from .message_utils import (
     addr_tokenize,
     emaildate_to_arrow,
-    email_get_body,
-    email_attachment_details,
-    safe_b64decode
+    analyze,
+    payload_size,
+    safe_b64decode,
+    BODY_POLICIES,
+    PLAIN_MIN_LENGTH,
+    PLAIN_MIN_RATIO
 )
-from .config import Configuration
+from .config import Configuration, ConfigurationError
+from .html_text import html_to_text
+from . import indices
+from .indices import INDEX_PREFIX
 
 
 logger = logging.getLogger(__name__)
 
+BULK_MAX_BYTES = 50 * 1024 * 1024
+TEMPLATE_NAME = 'email-message-index'
+# Bump when the index body changes so running daemons replace the installed template
+TEMPLATE_VERSION = 2
+# Responses worth retrying later: overload, timeouts and unavailable nodes or shards
+TRANSIENT_STATUS = (408, 429, 500, 502, 503, 504)
+TRANSIENT_ERRORS = ('es_rejected_execution_exception', 'circuit_breaking_exception',
+                    'unavailable_shards_exception', 'process_cluster_event_timeout_exception')
+
 
 class Indexer:
 
     es = None
 
+    def __init__(self):
+        # Indices known to exist, only checked for once per process
+        self.known_indices = set()
+        config = Configuration.INDEXER
+        self.body_policy = config.get('body_policy', 'prefer_html')
+        if self.body_policy not in BODY_POLICIES:
+            raise ConfigurationError('Unknown body policy {}, expected one of {}'.format(
+                self.body_policy, ', '.join(BODY_POLICIES)))
+        self.plain_min_length = config.get('plain_min_length', PLAIN_MIN_LENGTH)
+        self.plain_min_ratio = config.get('plain_min_ratio', PLAIN_MIN_RATIO)
+        # Bodies indexed from HTML or text, and HTML parts skipped for a text alternative (count and bytes), keyed
+        # by `<policy>:<outcome>`. Collected by the daemons, see index_daemon.record_body_selection
+        self.body_selection = Counter()
+
     def connect(self):
         config = Configuration.ELASTIC
         elasticsearch.Elasticsearch()
@@ -35,6 +65,7 @@ class Indexer:
             import urllib3
             urllib3.disable_warnings()
         self.es = elasticsearch.Elasticsearch(**config)
+        self.install_template()
 
     def _ensure_connection(method):
         @wraps(method)
@@ -47,15 +78,112 @@ class Indexer:
     @staticmethod
     def get_index_name(msg_date):
         """
-        Return our ES index name baed on `msg_date`
+        Return our ES index name based on `msg_date`, see indices.get_index_name
         """
-        return 'email-message-index-{}'.format(msg_date.format('YYYYMM'))
+        return indices.get_index_name(msg_date)
 
     @_ensure_connection
     def create_message_index(self, index_name):
         """
         Create an Email messagestore index at `index_name
         """
+        self.es.indices.create(**self.get_index_creation(index_name))
+
+    @classmethod
+    def get_index_creation(cls, index_name):
+        """
+        Return the arguments of the index creation request for `index_name`. The rollover write alias is created
+        along with the first rollover index.
+        """
+        body = cls.get_index_body()
+        if index_name == indices.WRITE_ALIAS:
+            body['aliases'] = {indices.WRITE_ALIAS: {'is_write_index': True}}
+            return dict(index=indices.ROLLOVER_INDEX, body=body)
+        return dict(index=index_name, body=body)
+
+    @_ensure_connection
+    def rollover(self):
+        """
+        Roll the write alias over to a new index if the current one meets the configured conditions. Returns
+        the name of the new index, or None.
+        """
+        self.ensure_indices([indices.WRITE_ALIAS])
+        result = self.es.indices.rollover(indices.WRITE_ALIAS,
+                                          body={'conditions': indices.get_rollover_conditions()})
+        return result['new_index'] if result.get('rolled_over') else None
+
+    def install_template(self):
+        """
+        Install (or upgrade) the index template, so indices auto-created by a bulk request get our settings and
+        mappings
+        """
+        try:
+            installed = self.es.indices.get_template(TEMPLATE_NAME)
+        except NotFoundError:
+            installed = {}
+        for method, kwargs in self.get_template_requests(installed):
+            getattr(self.es.indices, method)(**kwargs)
+
+    @classmethod
+    def get_template_requests(cls, installed):
+        """
+        Return the index API requests, as (method name, arguments), that install the template unless the
+        `get_template` response `installed` already has the current version
+        """
+        if installed.get(TEMPLATE_NAME, {}).get('version') == TEMPLATE_VERSION:
+            return []
+        logger.info('Installing index template {} version {}'.format(TEMPLATE_NAME, TEMPLATE_VERSION))
+        return [('put_template', dict(name=TEMPLATE_NAME, body=cls.get_template_body())),
+                # The template only adds the read alias to new indices
+                ('put_alias', dict(index=INDEX_PREFIX + '*', name=indices.READ_ALIAS, ignore=404))]
+
+    @classmethod
+    def get_template_body(cls):
+        body = cls.get_index_body()
+        body['index_patterns'] = [INDEX_PREFIX + '*']
+        body['aliases'] = {indices.READ_ALIAS: {}}
+        body['version'] = TEMPLATE_VERSION
+        return body
+
+    @_ensure_connection
+    def ensure_indices(self, index_names):
+        """
+        Create any of `index_names` that do not exist yet. Indices are only looked up once per process.
+        Returns the names of the indices created.
+        """
+        created = []
+        for index_name in self.unknown_indices(index_names):
+            if not self.es.indices.exists(index_name):
+                try:
+                    self.create_message_index(index_name)
+                    created.append(index_name)
+                except RequestError as e:
+                    if not is_already_exists(e):
+                        raise
+            self.known_indices.add(index_name)
+        return created
+
+    def unknown_indices(self, index_names):
+        """
+        Return those of `index_names` not known to exist yet
+        """
+        return set(index_names) - self.known_indices
+
+    def split_missing(self, failed):
+        """
+        Split the bulk failures `failed`, a list of (action, error), into the actions whose index does not exist
+        (deleted since it was cached, or auto-creation is disabled) and the other failures. Those indices are
+        forgotten, so the actions can be retried once `ensure_indices` created them again.
+        """
+        missing = [action for action, error in failed if bulk_error_type(error) == 'index_not_found_exception']
+        self.known_indices -= set(action['_index'] for action in missing)
+        return missing, [x for x in failed if bulk_error_type(x[1]) != 'index_not_found_exception']
+
+    @staticmethod
+    def get_index_body():
+        """
+        Return the settings and mappings of an Email messagestore index
+        """
         def _email_addr_multifield():
             return {"type": "text",
                     "analyzer": "email_address",
@@ -110,7 +238,10 @@ class Indexer:
                 }
             }
         }
-        self.es.indices.create(index_name, body=index_body)
+        return index_body
+
+    def count_body(self, outcome, count=1):
+        self.body_selection['{}:{}'.format(self.body_policy, outcome)] += count
 
     @_ensure_connection
     def process_message(self, message_path, message):
@@ -118,10 +249,50 @@ class Indexer:
         Process a single email.Message object into the index. Message path is expected to be the relative path
         from the root of the on-disk message storage.
         """
+        action = self.prepare_message(message_path, message)
+        if action is None:
+            return False
+
+        self.ensure_indices([action['_index']])
+        self.es.index(index=action['_index'],
+                      id=action['_id'],
+                      body=action['_source'])
+
+        logger.info('Indexed {}'.format(action['_source']['message_id']))
+
+    @_ensure_connection
+    def index_bulk(self, actions):
+        """
+        Index a list of actions from `prepare_message` through the bulk API. Returns a list of (action, error)
+        for the actions that could not be indexed.
+        """
+        self.ensure_indices(action['_index'] for action in actions)
+        failed = self._bulk(actions)
+        missing, failed = self.split_missing(failed)
+        if missing:
+            self.ensure_indices(action['_index'] for action in missing)
+            failed.extend(self._bulk(missing))
+
+        logger.info('Indexed {} messages, {} failed'.format(len(actions) - len(failed), len(failed)))
+        return failed
+
+    def _bulk(self, actions):
+        results = helpers.streaming_bulk(self.es, actions,
+                                         chunk_size=max(len(actions), 1),
+                                         max_chunk_bytes=BULK_MAX_BYTES,
+                                         raise_on_error=False,
+                                         raise_on_exception=False)
+        return [(action, info) for action, (ok, info) in zip(actions, results) if not ok]
+
+    def prepare_message(self, message_path, message):
+        """
+        Parse a single email.Message object into a bulk index action (a dict with _index, _id and _source),
+        or None if the message cannot be indexed.
+        """
         message_id = message['Message-Id']
         if message_id is None:
             logger.warn('Skipping {}, could not find a Message-Id, probably an error parsing'.format(message_path))
-            return False
+            return None
         msg_subject = str(message.get('Subject', ''))
         msg_headers = ['{}: {}'.format(x, y) for x, y in message.items()]
         msg_date = emaildate_to_arrow(message['Date'])
@@ -129,12 +300,17 @@ class Indexer:
         msg_cc = addr_tokenize(message.get('CC'))
         msg_bcc = addr_tokenize(message.get('BCC'))
         msg_to = addr_tokenize(message['To'])
-        msg_attachments = email_attachment_details(message)
+        summary = analyze(message, self.body_policy, min_length=self.plain_min_length,
+                          min_ratio=self.plain_min_ratio)
+        msg_attachments = summary.attachment_details
 
         has_valid_body = False
-        msg_body = email_get_body(message)
+        msg_body = summary.body
+        if summary.skipped_html is not None:
+            self.count_body('html_skipped')
+            self.count_body('html_skipped_bytes', payload_size(summary.skipped_html))
         if msg_body is not None:
-            content_type = msg_body.get('Content-Type', 'application/octet-stream')
+            content_type = summary.body_type or 'application/octet-stream'
             if content_type.startswith('text/'):
                 encoding = msg_body.get('Content-Transfer-Encoding')
                 charset = msg_body.get_param('charset')
@@ -187,8 +363,11 @@ class Indexer:
                             logger.warning('         ' + '****'*4 + '   ^^^   ' + '****'*4)
                             body_text = body_text.decode(charset and charset or 'utf8', 'ignore')
 
-                if 'text/html' in content_type:
-                    body_text = bleach.clean(body_text, tags=[], attributes={}, styles=[], strip=True)
+                if content_type == 'text/html':
+                    body_text = html_to_text(body_text)
+                    self.count_body('html')
+                else:
+                    self.count_body('text')
                 has_valid_body = True
 
         if not has_valid_body:
@@ -215,15 +394,68 @@ class Indexer:
         document_id_parts = ''.join(document_id_parts).encode('utf8')
         document_id = hashlib.sha256(document_id_parts).hexdigest()
 
-        def _try_index():
-            self.es.index(index=index_name,
-                          id=document_id,
-                          body=message_index_body)
+        return {'_index': index_name,
+                '_id': document_id,
+                '_source': message_index_body}
+
+
+def bulk_error_type(info):
+    """Return the Elasticsearch error type of a failed `streaming_bulk` result, if known"""
+    for result in info.values():
+        error = result.get('error')
+        if isinstance(error, dict):
+            return error.get('type')
+        if 'exception' in result and isinstance(result['exception'], TransportError):
+            return result['exception'].error
+    return None
+
+
+def is_already_exists(exc):
+    """Whether a RequestError creating an index means another worker created it first"""
+    return exc.error == 'resource_already_exists_exception'
+
+
+def is_transient_exception(exc):
+    """Whether an exception raised while preparing or indexing messages is likely to go away on retry"""
+    if isinstance(exc, elasticsearch.ConnectionError):
+        return True
+    if isinstance(exc, TransportError):
+        return exc.status_code in TRANSIENT_STATUS or exc.error in TRANSIENT_ERRORS
+    return isinstance(exc, (ConnectionError, TimeoutError))
+
+
+def is_transient_bulk_error(info):
+    """Whether a failed `streaming_bulk` result is likely to succeed on retry"""
+    for result in info.values():
+        if 'exception' in result:
+            return is_transient_exception(result['exception'])
+        return result.get('status') in TRANSIENT_STATUS or bulk_error_type(info) in TRANSIENT_ERRORS
+    return False
+
+
+def is_rejection(error):
+    """Whether an exception or failed `streaming_bulk` result means the cluster is refusing work, overloaded"""
+    if isinstance(error, TransportError):
+        return error.status_code == 429 or error.error == 'es_rejected_execution_exception'
+    if isinstance(error, dict):
+        for result in error.values():
+            if 'exception' in result:
+                return is_rejection(result['exception'])
+            return result.get('status') == 429 or bulk_error_type(error) == 'es_rejected_execution_exception'
+    return False
 
-        try:
-            _try_index()
-        except NotFoundError:
-            self.create_message_index(index_name)
-            _try_index()
 
-        logger.info('Indexed {}'.format(message_id))
+def describe_error(error):
+    """Return (error type, message, transient) for an exception or a failed `streaming_bulk` result"""
+    if isinstance(error, TransportError) and isinstance(error.error, str):
+        return error.error, str(error), is_transient_exception(error)
+    if isinstance(error, BaseException):
+        return type(error).__name__, str(error), is_transient_exception(error)
+    for result in error.values():
+        if 'exception' in result:
+            return describe_error(result['exception'])
+        reason = result.get('error')
+        if isinstance(reason, dict):
+            reason = reason.get('reason')
+        return bulk_error_type(error) or str(result.get('status')), str(reason), is_transient_bulk_error(error)
+    return None, str(error), False
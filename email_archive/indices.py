@@ -0,0 +1,155 @@
+"""
+Index naming. Messages are routed to an index by the UTC date of the message, one index per day, ISO week, month
+(the default) or year, set by `indexer.index_granularity`. The granularity can also change over time, eg. yearly
+indices for old, sparse mail and monthly ones for recent mail, by mapping the first date of each period to its
+granularity instead.
+
+Index names sort by date within a year: email-message-index-YYYY, -YYYYMM, -YYYYMMDD and -YYYYwWW (ISO year and
+week). `resolve_indices` returns the indices to query for a date range, collapsing whole years and months into
+wildcards to keep the list short.
+
+With `rollover` granularity messages are written through the `email-message-write` alias instead, to a new
+index whenever the current one meets the `indexer.rollover` conditions (checked by `ensure-indices`). Rollover
+indices are not routed by date, so searches go to every one of them.
+
+Every index is also reachable through the `email-message` alias.
+"""
+import datetime
+
+import arrow
+
+from .config import Configuration, ConfigurationError
+
+
+INDEX_PREFIX = 'email-message-index-'
+READ_ALIAS = 'email-message'
+WRITE_ALIAS = 'email-message-write'
+# Rollover increments the trailing number of the name
+ROLLOVER_INDEX = INDEX_PREFIX + 'rollover-000001'
+GRANULARITIES = ('day', 'week', 'month', 'year', 'rollover')
+DEFAULT_GRANULARITY = 'month'
+DEFAULT_ROLLOVER = {'max_size': '50gb'}
+
+
+def get_schedule():
+    """Return the configured granularities as (first date, granularity) tuples, latest first. The first date of
+    the earliest granularity is None."""
+    config = Configuration.INDEXER.get('index_granularity', DEFAULT_GRANULARITY)
+    if not isinstance(config, dict):
+        config = {None: config}
+    schedule = []
+    for since, granularity in config.items():
+        if granularity not in GRANULARITIES:
+            raise ConfigurationError('Unknown index granularity {}, expected one of {}'.format(
+                granularity, ', '.join(GRANULARITIES)))
+        if granularity == 'rollover' and len(config) > 1:
+            raise ConfigurationError('rollover index granularity cannot be combined with others')
+        schedule.append((arrow.get(since).date() if since is not None else None, granularity))
+    schedule.sort(key=lambda x: x[0] or datetime.date.min, reverse=True)
+    # Dates before the earliest configured one use the earliest granularity
+    return schedule[:-1] + [(None, schedule[-1][1])]
+
+
+def is_rollover():
+    return get_schedule()[0][1] == 'rollover'
+
+
+def get_rollover_conditions():
+    return Configuration.INDEXER.get('rollover') or DEFAULT_ROLLOVER
+
+
+def get_granularity(day, schedule=None):
+    for since, granularity in schedule or get_schedule():
+        if since is None or day >= since:
+            return granularity
+
+
+def period_start(day, granularity):
+    if granularity == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    elif granularity == 'month':
+        return day.replace(day=1)
+    elif granularity == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def next_period(start, granularity):
+    if granularity == 'week':
+        return start + datetime.timedelta(days=7)
+    elif granularity == 'month':
+        return (start + datetime.timedelta(days=32)).replace(day=1)
+    elif granularity == 'year':
+        return start.replace(year=start.year + 1)
+    return start + datetime.timedelta(days=1)
+
+
+def period_name(start, granularity):
+    if granularity == 'week':
+        return '{}{}w{:02}'.format(INDEX_PREFIX, *start.isocalendar()[:2])
+    fmt = {'day': '%Y%m%d', 'month': '%Y%m', 'year': '%Y'}[granularity]
+    return '{}{}'.format(INDEX_PREFIX, start.strftime(fmt))
+
+
+def get_index_name(msg_date):
+    """Return the index (or write alias) for a message sent at `msg_date`, an arrow object or datetime in UTC"""
+    schedule = get_schedule()
+    if schedule[0][1] == 'rollover':
+        return WRITE_ALIAS
+    day = arrow.get(msg_date).date()
+    granularity = get_granularity(day, schedule)
+    return period_name(period_start(day, granularity), granularity)
+
+
+def iter_periods(start, end):
+    """Yield (first day, granularity) of every dated index holding messages from `start` to `end` inclusive"""
+    schedule = get_schedule()
+    boundaries = sorted(since for since, _ in schedule if since is not None)
+    day = arrow.get(start).date()
+    end = arrow.get(end).date()
+    while day <= end:
+        granularity = get_granularity(day, schedule)
+        first = period_start(day, granularity)
+        yield first, granularity
+        # Stop short of the next period when the granularity changes within this one
+        day = min([next_period(first, granularity)] + [x for x in boundaries if x > day])
+
+
+def get_index_names(start, end):
+    """Return the names of the indices holding messages from `start` to `end` inclusive"""
+    if is_rollover():
+        return [WRITE_ALIAS]
+    names = []
+    for first, granularity in iter_periods(start, end):
+        name = period_name(first, granularity)
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def resolve_indices(start=None, end=None):
+    """Return the index names and patterns to search for messages from `start` to `end` inclusive, dates,
+    datetimes or arrow objects in UTC. Open ranges and rollover indices resolve to the read alias. Patterns
+    matching no index are ignored by Elasticsearch, searches should also pass ignore_unavailable=True for
+    periods without messages."""
+    if start is None or end is None or is_rollover():
+        return [READ_ALIAS]
+    start = arrow.get(start).date()
+    end = arrow.get(end).date()
+    periods = list(iter_periods(start, end))
+    names = []
+    for year in sorted(set(first.year for first, _ in periods)):
+        in_year = [(first, granularity) for first, granularity in periods if first.year == year]
+        if (start <= datetime.date(year, 1, 1) and datetime.date(year, 12, 31) <= end and
+                'week' not in [granularity for _, granularity in in_year]):
+            names.append('{}{}*'.format(INDEX_PREFIX, year))
+            continue
+        for first, granularity in in_year:
+            name = period_name(first, granularity)
+            if granularity == 'day':
+                month = first.replace(day=1)
+                if start <= month and next_period(month, 'month') <= end + datetime.timedelta(days=1):
+                    name = '{}{}*'.format(INDEX_PREFIX, month.strftime('%Y%m'))
+            if name not in names:
+                names.append(name)
+    return names
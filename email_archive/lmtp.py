@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Long-running LMTP ingest server. Replaces the per-message `archive-message` pipe process, reusing
+one loaded configuration, domain matcher and Redis connection pool for every delivery.
+"""
+import os
+import sys
+import socket
+import asyncio
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import Configuration
+from . import fifo
+from . import archive
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 2424
+DEFAULT_WORKERS = 8
+LINE_LIMIT = 1024 * 1024
+SPOOL_SIZE = 1024 * 1024
+HOSTNAME = socket.getfqdn()
+
+
+class LMTPServer(object):
+    """Accepts LMTP deliveries and hands complete messages to `archive.archive_message` in a
+    thread pool so slow disk or Redis writes never stall other connections"""
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.matcher = archive.get_domain_matcher()
+        self.queue = fifo.open_queue(archive.connect())
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def archive(self, data):
+        try:
+            data.seek(0)
+            return archive.archive_stream(data, queue=self.queue, matcher=self.matcher)
+        finally:
+            data.close()
+
+    async def handle(self, reader, writer):
+        session = LMTPSession(self, reader, writer)
+        try:
+            await session.run()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logger.debug('Client disconnected')
+        except Exception:
+            logger.exception('Unhandled exception in LMTP session')
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host=None, port=DEFAULT_PORT):
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(self.handle, path=path, limit=LINE_LIMIT)
+            logger.info('Listening for LMTP on unix:{}'.format(path))
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port, limit=LINE_LIMIT)
+            logger.info('Listening for LMTP on {}:{}'.format(host or '*', port))
+        async with server:
+            await server.serve_forever()
+
+
+class LMTPSession(object):
+    """State for a single LMTP client connection (RFC 2033)"""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.reset()
+
+    def reset(self):
+        self.mail_from = None
+        self.recipients = []
+
+    async def reply(self, *lines):
+        self.writer.write(''.join('{}\r\n'.format(x) for x in lines).encode('ascii'))
+        await self.writer.drain()
+
+    async def readline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed')
+        return line
+
+    async def run(self):
+        await self.reply('220 {} LMTP email_archive ready'.format(HOSTNAME))
+        while True:
+            try:
+                line = await self.readline()
+            except ValueError:
+                await self.reply('500 5.5.2 Line too long')
+                return
+            command, _, arg = line.decode('ascii', 'replace').strip().partition(' ')
+            command = command.upper()
+
+            if command == 'LHLO':
+                self.reset()
+                await self.reply('250-{}'.format(HOSTNAME),
+                                 '250-PIPELINING',
+                                 '250-ENHANCEDSTATUSCODES',
+                                 '250 8BITMIME')
+            elif command == 'MAIL':
+                self.reset()
+                self.mail_from = arg
+                await self.reply('250 2.1.0 Ok')
+            elif command == 'RCPT':
+                if self.mail_from is None:
+                    await self.reply('503 5.5.1 Need MAIL first')
+                else:
+                    self.recipients.append(arg)
+                    await self.reply('250 2.1.5 Ok')
+            elif command == 'DATA':
+                if not self.recipients:
+                    await self.reply('503 5.5.1 Need RCPT first')
+                    continue
+                await self.reply('354 Start mail input; end with <CRLF>.<CRLF>')
+                data = await self.read_data()
+                if data is None:
+                    status = '552 5.3.4 Line too long'
+                else:
+                    status = await self.deliver(data)
+                # LMTP replies once per accepted recipient
+                await self.reply(*[status] * len(self.recipients))
+                self.reset()
+            elif command == 'RSET':
+                self.reset()
+                await self.reply('250 2.0.0 Ok')
+            elif command == 'NOOP':
+                await self.reply('250 2.0.0 Ok')
+            elif command == 'VRFY':
+                await self.reply('252 2.5.0 Cannot VRFY user')
+            elif command == 'QUIT':
+                await self.reply('221 2.0.0 Bye')
+                return
+            else:
+                await self.reply('500 5.5.2 Command not recognized')
+
+    async def read_data(self):
+        """Read a dot-terminated DATA section into a spool file, undoing dot-stuffing. If a line is longer than
+        LINE_LIMIT the rest of the section is drained and None returned"""
+        data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        too_long = False
+        complete = False
+        try:
+            while True:
+                try:
+                    line = await self.readline()
+                except ValueError:
+                    # The reader discarded the line
+                    too_long = True
+                    continue
+                if line in (b'.\r\n', b'.\n'):
+                    break
+                if too_long:
+                    continue
+                if line.startswith(b'.'):
+                    line = line[1:]
+                data.write(line)
+            complete = not too_long
+        finally:
+            if not complete:
+                data.close()
+        return data if complete else None
+
+    async def deliver(self, data):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.server.executor, self.server.archive, data)
+        except Exception:
+            logger.exception('Unable to archive message from {}'.format(self.mail_from))
+            # Temporary failure, Postfix will retry the delivery
+            return '451 4.3.0 Error archiving message'
+        return '250 2.0.0 Ok'
+
+
+def run(path=None, host=None, port=None, workers=None):
+    config = Configuration.LMTP
+    if path is None and host is None:
+        path = config.get('socket')
+        host = config.get('host')
+    if port is None:
+        port = config.get('port', DEFAULT_PORT)
+    if workers is None:
+        workers = config.get('workers', DEFAULT_WORKERS)
+
+    server = LMTPServer(workers=workers)
+    try:
+        asyncio.run(server.serve(path=path, host=host, port=port))
+    except KeyboardInterrupt:
+        print('\nExiting by user request.\n')
+        sys.exit(0)
@@ -6,7 +6,8 @@ from email.header import Header
 
 import arrow
 
-from .altgzip import AltGzipFile
+from . import compression
+from . import segments
 
 
 def addr_tokenize(header_value):
@@ -41,27 +42,148 @@ def emaildate_to_arrow(date):
     return arrow.get(email.utils.mktime_tz(email.utils.parsedate_tz(date)))
 
 
+BODY_POLICIES = ('prefer_html', 'prefer_plain', 'auto')
+# With the auto policy a text/plain alternative is used if it is at least this long, or this long relative to the
+# text/html alternative, so placeholders such as "view this message in a browser" are not indexed as the body
+PLAIN_MIN_LENGTH = 1000
+PLAIN_MIN_RATIO = 0.1
+
+
+class MessageSummary(object):
+    """
+    What `analyze` found in a message: the body part (or None) and the lowercase type its Content-Type header
+    declares (None without one), the text/html part skipped in favour of it (or None), attachments as
+    (<filename>, <mime>, <size>) tuples, the number of MIME parts and their content types in walk order
+    """
+    __slots__ = ('body', 'body_type', 'skipped_html', 'attachments', 'part_count', 'content_types')
+
+    def __init__(self, body=None, body_type=None, skipped_html=None, attachments=None, content_types=None):
+        self.body = body
+        self.body_type = body_type
+        self.skipped_html = skipped_html
+        self.attachments = attachments or []
+        self.content_types = content_types or []
+        self.part_count = len(self.content_types)
+
+    @property
+    def attachment_details(self):
+        """Attachments as (<filename>, <mime>) tuples, see `email_attachment_details`"""
+        return [(filename, content_type) for filename, content_type, _ in self.attachments]
+
+    def __repr__(self):
+        return '<{} parts={} body={} attachments={}>'.format(self.__class__.__name__, self.part_count,
+                                                             self.body and self.body.get_content_type(),
+                                                             len(self.attachments))
+
+
+def _walk(message):
+    """Yield every part of `message` in the order of Message.walk, with its content type and the nearest
+    multipart/alternative part containing it. Iterative, so the cost of a part does not grow with its depth."""
+    stack = [(message, None)]
+    while stack:
+        part, alternative = stack.pop()
+        content_type = part.get_content_type()
+        yield part, content_type, alternative
+        if part.is_multipart():
+            if content_type == 'multipart/alternative':
+                alternative = part
+            stack.extend((x, alternative) for x in reversed(part.get_payload()))
+
+
+def _declared_type(part):
+    """The lowercase type of the Content-Type header of `part`, or None without one. Unlike get_content_type,
+    parts without the header do not default to text/plain."""
+    header = part.get('Content-Type')
+    if header is None:
+        return None
+    return str(header).split(';', 1)[0].strip().lower()
+
+
+def payload_size(part):
+    """Approximate decoded size of a non-multipart part, without decoding it"""
+    payload = part.get_payload()
+    if not isinstance(payload, (str, bytes)):
+        return 0
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    if encoding == 'base64':
+        newline = '\n' if isinstance(payload, str) else b'\n'
+        return (len(payload) - payload.count(newline)) * 3 // 4
+    if encoding == 'quoted-printable':
+        # Each =XX escape decodes to a single byte, and soft line breaks (=\n) to nothing
+        escape = '=' if isinstance(payload, str) else b'='
+        return max(len(payload) - 2 * payload.count(escape), 0)
+    return len(payload)
+
+
+def analyze(message, policy='prefer_html', min_length=PLAIN_MIN_LENGTH, min_ratio=PLAIN_MIN_RATIO):
+    """
+    Walk the MIME tree of `message` once and return a MessageSummary.
+
+    The body is a best-effort guess, chosen according to `policy` when the message has both a text/html and a
+    text/plain part:
+      - prefer_html: the text/html part
+      - prefer_plain: the text/plain part
+      - auto: the text/plain part if it is an alternative to the text/html part and at least `min_length`
+        characters or `min_ratio` times as long, the text/html part otherwise
+    Only parts whose Content-Type header declares text/html or text/plain are body candidates, in any case, not
+    parts that merely default to text/plain. Non-multipart messages are their own body. Attachments are all parts
+    other than text/html, text/plain (declared or by default) and multipart containers.
+    """
+    html_part = html_alternative = None
+    text_part = text_alternative = None
+    attachments = []
+    content_types = []
+    for part, content_type, alternative in _walk(message):
+        content_types.append(content_type)
+        if content_type in ('text/html', 'text/plain'):
+            declared = _declared_type(part)
+            if declared == 'text/html':
+                html_part, html_alternative = part, alternative
+            elif declared == 'text/plain':
+                text_part, text_alternative = part, alternative
+        elif not content_type.startswith('multipart/'):
+            attachments.append((part.get_filename('unknown.bin'), content_type, payload_size(part)))
+
+    summary = MessageSummary(attachments=attachments, content_types=content_types)
+    if not message.is_multipart():
+        summary.body = message
+    elif html_part is None or text_part is None or policy == 'prefer_html':
+        summary.body = html_part or text_part
+    elif policy == 'auto' and not _is_plain_alternative(text_part, text_alternative, html_part, html_alternative,
+                                                        min_length, min_ratio):
+        summary.body = html_part
+    else:
+        summary.body, summary.skipped_html = text_part, html_part
+    if summary.body is not None:
+        summary.body_type = _declared_type(summary.body)
+    return summary
+
+
+def _is_plain_alternative(text_part, text_alternative, html_part, html_alternative, min_length, min_ratio):
+    if html_alternative is None or html_alternative is not text_alternative:
+        return False
+    # Decoded sizes, a base64 or quoted-printable encoding must not tip the balance
+    text_length = payload_size(text_part)
+    return text_length >= min_length or text_length >= min_ratio * payload_size(html_part)
+
+
+def select_body(message, policy='prefer_html', min_length=PLAIN_MIN_LENGTH, min_ratio=PLAIN_MIN_RATIO):
+    """
+    Return the body part of `message` (or None) and the text/html part skipped in favour of it (or None), see
+    `analyze`
+    """
+    summary = analyze(message, policy, min_length=min_length, min_ratio=min_ratio)
+    return summary.body, summary.skipped_html
+
+
 def email_get_body(message):
     """
     Make a best-effort guess at which part of an email message is the body and return it.
-    Prefers text/html over text/plain. Non-multipart messages will be returned in full.
+    Prefers text/html over text/plain, see `analyze` for other policies. Non-multipart messages will be
+    returned in full.
     Always returns a Message or MIME* object
     """
-    if not message.is_multipart():
-        return message
-    else:
-        html_part = None
-        text_part = None
-        for part in message.walk():
-            content_type = part.get('Content-Type', 'application/octet-stream')
-            if isinstance(content_type, Header):
-                content_type = str(content_type)
-            if not part.is_multipart():
-                if 'text/html' in content_type:
-                    html_part = part
-                if 'text/plain' in content_type:
-                    text_part = part
-        return html_part or text_part or None
+    return analyze(message).body
 
 
 def email_attachment_details(message):
@@ -69,46 +191,20 @@ def email_attachment_details(message):
     Make a best-effort list of attachment filenames and mimetypes,
     return a list of 2-tuples: [(<filename>, <mime>), ...]
     """
-    if not message.is_multipart():
-        parts = [message]
-    else:
-        parts = message.walk()
-
-    attachments = []
-    for part in parts:
-        filename = part.get_filename('unknown.bin')
-        content_type = part.get_content_type()
-        if 'text/html' in content_type or 'text/plain' in content_type or content_type.startswith('multipart/'):
-            continue
-        attachments.append((filename, content_type))
-    return attachments
+    return analyze(message).attachment_details
 
 
 def email_has_attachments(message):
     """Make a best-effort guess if an email has attachments. Skips text/html and text/plain"""
-    if not message.is_multipart():
-        return False
-
-    found = False
-    for part in message.walk():
-        content_type = part.get('Content-Type', 'application/octet-stream')
-        if 'text/html' in content_type or \
-        'text/plain' in content_type:
-            continue
-        found = True
-
-    return found
+    return message.is_multipart() and bool(analyze(message).attachments)
 
 
 def gz_open(path):
-    """Transparently open regular and Gzipped files"""
-    fd = open(path, 'rb')
-    if fd.read(2) == b'\x1f\x8b':
-        fd.seek(0)
-        return AltGzipFile(fileobj=fd)
-    else:
-        fd.seek(0)
-        return fd
+    """Transparently open regular, Gzipped and Zstandard files, as well as messages stored in segments
+    (`<segment path>:<offset>`)"""
+    if segments.parse_ref(path) is not None:
+        return segments.open_ref(path)
+    return compression.open_reader(open(path, 'rb'))
 
 
 def safe_b64decode(content):
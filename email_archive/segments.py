@@ -0,0 +1,96 @@
+"""
+Append-only segment storage. Messages for a 10 minute bucket are appended to a single segment file as
+independent gzip members or zstd frames, with a sidecar index recording the offset and length of every member. A single
+message is addressed by a reference of the form `<segment path>:<offset>` and can be read back without
+decompressing the rest of the segment.
+"""
+import os
+import io
+import fcntl
+import shutil
+import tempfile
+
+from . import compression
+
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+SPOOL_SIZE = 1024 * 1024
+
+
+def index_path(segment_path):
+    return segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+
+def make_ref(segment_path, offset):
+    return '{}:{}'.format(segment_path, offset)
+
+
+def parse_ref(ref):
+    """Split a segment reference into (segment_path, offset). Returns None if `ref` is not a segment reference"""
+    path, _, offset = str(ref).rpartition(':')
+    if not path.endswith(SEGMENT_SUFFIX) or not offset.isdigit():
+        return None
+    return path, int(offset)
+
+
+def append(segment_path, chunks, key='', committer=None):
+    """Append the bytestrings in `chunks` to the segment as a new member using the configured codec and record
+    it in the sidecar index. Safe against concurrent writers in other processes. If a `committer` is given
+    the segment and index are durably synced before returning. Returns the offset and compressed length of the
+    new member."""
+    registered = committer is not None
+    if registered:
+        committer.begin()
+    try:
+        # Compress into a spool first so the segment lock is only held while copying the finished member
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            with compression.open_writer(fileobj=spool, framed=True) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+            length = spool.tell()
+            spool.seek(0)
+
+            with open(segment_path, 'ab') as fd, open(index_path(segment_path), 'a') as idx:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    offset = fd.seek(0, os.SEEK_END)
+                    shutil.copyfileobj(spool, fd)
+                    fd.flush()
+                    # The index is only written once the member is complete, readers of the index never see a torn member
+                    idx.write('{} {} {}\n'.format(offset, length, key))
+                    idx.flush()
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+                if committer is not None:
+                    # A new segment also needs its directory entry synced
+                    registered = False
+                    committer.commit([fd, idx], directory=os.path.dirname(segment_path) if offset == 0 else None)
+    finally:
+        if registered:
+            committer.abandon()
+    return offset, length
+
+
+def read_member(segment_path, offset):
+    """Decompress the single member starting at `offset`"""
+    with open(segment_path, 'rb') as fd:
+        fd.seek(offset)
+        return compression.read_member(fd)
+
+
+def open_ref(ref):
+    """Open a segment reference, returning a file-like object with the decompressed message"""
+    segment_path, offset = parse_ref(ref)
+    return io.BytesIO(read_member(segment_path, offset))
+
+
+def iter_index(segment_path):
+    """Yield (offset, length, key) for every member recorded in the segment's sidecar index"""
+    with open(index_path(segment_path)) as idx:
+        for line in idx:
+            if not line.endswith('\n'):
+                continue  # Torn final line
+            parts = line.split()
+            yield int(parts[0]), int(parts[1]), parts[2] if len(parts) > 2 else ''
@@ -0,0 +1,95 @@
+"""
+Pre-forking process supervisor. Heavy modules are imported once in the supervisor before forking so their
+pages are shared copy-on-write between workers. Workers that exit are restarted with the same target: a clean
+exit is a recycle (eg. after processing `max_messages`), anything else is logged as a crash.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+MIN_LIFETIME = 5.0
+RESTART_DELAY = 5.0
+
+
+class Supervisor(object):
+
+    def __init__(self, target=None, workers=0, preload=None):
+        """`target` is called in each forked worker and should return when the worker is to be recycled"""
+        self.pools = []
+        self.preload = preload
+        self.children = {}
+        self.stopping = False
+        if target is not None:
+            self.add(target, workers)
+
+    def add(self, target, workers):
+        """Run `workers` processes of another `target`"""
+        self.pools.append((target, workers))
+
+    def spawn(self, target):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                # Interrupts reach the whole process group, workers wait for the supervisor's SIGTERM instead
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                target()
+            except Exception:
+                logger.exception('Unhandled exception in worker {}'.format(os.getpid()))
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        logger.info('Started worker {}'.format(pid))
+        self.children[pid] = (target, time.monotonic())
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        logger.info('Stopping {} workers'.format(len(self.children)))
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        if self.preload is not None:
+            self.preload()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for target, workers in self.pools:
+            for _ in range(workers):
+                self.spawn(target)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            child = self.children.pop(pid, None)
+            if child is None or self.stopping:
+                continue
+            target, started = child
+
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                logger.info('Worker {} exited, recycling'.format(pid))
+            else:
+                logger.warning('Worker {} died with status {}, restarting'.format(pid, status))
+                if time.monotonic() - started < MIN_LIFETIME:
+                    # Avoid a tight fork loop when workers fail at startup
+                    time.sleep(RESTART_DELAY)
+                    if self.stopping:
+                        continue
+            self.spawn(target)
+
+        logger.info('All workers stopped')
+        sys.exit(0)
@@ -11,7 +11,9 @@ setup(
     license='MIT',
     url='https://github.com/axonxorz/email_archive',
     install_requires=open('requirements.txt').readlines(),
-    extras_require=dict(dev=open('requirements-dev.txt').readlines()),
+    extras_require={'dev': open('requirements-dev.txt').readlines(),
+                    'zstd': ['zstandard>=0.15'],
+                    'async': ['aiohttp>=3.6,<4']},
     description='Email retention archiver and indexer for postfix',
     long_description=open('README.rst', 'r').read(),
     keywords=['python'],
@@ -0,0 +1,14 @@
+import pytest
+
+from email_archive.config import Configuration
+
+
+@pytest.fixture
+def configure(monkeypatch):
+    """Set configuration sections directly instead of loading a file, eg. configure(STORAGE={'codec': 'zstd'})"""
+    monkeypatch.setattr(Configuration, '_loaded', True)
+
+    def configure(**sections):
+        for name, value in sections.items():
+            monkeypatch.setattr(Configuration, '_' + name, value)
+    return configure
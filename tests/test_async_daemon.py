@@ -0,0 +1,78 @@
+import asyncio
+from collections import Counter
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+import redis
+
+from email_archive import async_daemon, index_daemon
+
+
+class FlakyConnection(fakeredis.aioredis.FakeRedis):
+    """Fails the first `failures` commands or pipelines it executes"""
+
+    def __init__(self, failures=0, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    def fail(self):
+        if self.failures:
+            self.failures -= 1
+            raise redis.ConnectionError('Connection reset')
+
+    async def execute_command(self, *args, **options):
+        self.fail()
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        pipeline = super().pipeline(*args, **kwargs)
+        execute = pipeline.execute
+
+        async def flaky_execute(*args, **kwargs):
+            self.fail()
+            return await execute(*args, **kwargs)
+        pipeline.execute = flaky_execute
+        return pipeline
+
+
+@pytest.fixture
+def daemon(configure, monkeypatch):
+    """A daemon with only its queue, on a connection that fails as often as told"""
+    configure(REDIS={'url': 'redis://', 'queue': 'q'}, ELASTIC={'hosts': ['localhost']})
+    monkeypatch.setattr(index_daemon, 'RECONNECT_INTERVAL', 0)
+    daemon = async_daemon.AsyncIndexDaemon.__new__(async_daemon.AsyncIndexDaemon)
+    daemon.conn = FlakyConnection(server=fakeredis.FakeServer())
+    daemon.queue = index_daemon.open_queue(daemon.conn)
+    daemon.stopping = asyncio.Event()
+    daemon.body_selection = Counter()
+    return daemon
+
+
+@pytest.mark.parametrize('failures', [0, 1, 3])
+def test_finish_retries_redis_errors(daemon, failures):
+    async def main():
+        conn = daemon.conn
+        await conn.hset('q:enqueued', mapping={'a': 1, 'b': 1})
+        await daemon.queue.fail([('a', 'ConnectionError', 'timeout', True)])
+        conn.failures = failures
+        daemon.body_selection.update({'prefer_html:html': 2})
+        await daemon.retry(daemon.mark_done, [b'a', b'b'])
+        await daemon.finish([b'a', b'b'], [('b', 'mapper_parsing_exception', 'failed to parse', False)])
+        return (await conn.hgetall('q:enqueued'), await conn.hgetall('q:attempts'),
+                await conn.xlen('q:dead-letters'),
+                await conn.hgetall(daemon.queue.get_queue(index_daemon.BODY_SELECTION)))
+
+    enqueued, attempts, dead_letters, body_selection = asyncio.run(main())
+    assert daemon.conn.failures == 0
+    assert enqueued == {}
+    assert attempts == {}
+    assert dead_letters == 1
+    assert body_selection == {b'prefer_html:html': b'2'}
+
+
+def test_retry_gives_up_when_stopping(daemon):
+    daemon.stopping.set()
+    daemon.conn.failures = 1
+    with pytest.raises(redis.ConnectionError):
+        asyncio.run(daemon.retry(daemon.mark_done, [b'a']))
@@ -0,0 +1,38 @@
+import io
+
+import pytest
+
+from email_archive import compression
+from email_archive.config import ConfigurationError
+
+
+@pytest.mark.parametrize('storage, codec, level', [
+    ({'codec': 'gzip'}, 'gzip', 9),
+    ({'codec': 'zstd'}, 'zstd', 3),
+    ({'codec': 'gzip', 'zstd_level': 19}, 'gzip', 9),
+    ({'codec': 'gzip', 'zstd_level': 19}, 'zstd', 19),
+    ({'codec': 'zstd', 'level': 19}, 'zstd', 19),
+    ({'codec': 'zstd', 'level': 19}, 'gzip', 9),
+    ({'codec': 'zstd', 'level': 19, 'zstd_level': 5}, 'zstd', 5),
+])
+def test_get_level(configure, storage, codec, level):
+    configure(STORAGE=storage)
+    assert compression.get_level(codec) == level
+
+
+@pytest.mark.parametrize('storage', [{'codec': 'gzip', 'level': 19}, {'codec': 'gzip', 'gzip_level': 'x'},
+                                     {'codec': 'zstd', 'zstd_level': 23}])
+def test_invalid_level(configure, storage):
+    configure(STORAGE=storage)
+    with pytest.raises(ConfigurationError):
+        compression.open_writer(fileobj=io.BytesIO())
+
+
+@pytest.mark.parametrize('codec', compression.CODECS)
+def test_roundtrip(configure, codec):
+    configure(STORAGE={'codec': codec})
+    raw = io.BytesIO()
+    with compression.open_writer(fileobj=raw) as writer:
+        writer.write(b'Message-ID: <1@example.com>\r\n\r\nBody\r\n')
+    raw.seek(0)
+    assert compression.open_reader(raw).read() == b'Message-ID: <1@example.com>\r\n\r\nBody\r\n'
@@ -0,0 +1,32 @@
+import pytest
+
+from email_archive.domains import DomainMatcher
+
+
+@pytest.fixture
+def matcher():
+    return DomainMatcher(['Example.com', 'other.org.', '*.wild.net'])
+
+
+@pytest.mark.parametrize('domain, matched', [
+    ('example.com', True),
+    ('EXAMPLE.COM.', True),
+    ('mail.example.com', True),
+    ('a.b.example.com', True),
+    ('notexample.com', False),
+    ('example.com.au', False),
+    ('other.org', True),
+    ('sub.other.org', True),
+    ('wild.net', False),
+    ('sub.wild.net', True),
+    ('a.sub.wild.net', True),
+    ('com', False),
+])
+def test_match_domain(matcher, domain, matched):
+    assert matcher.match_domain(domain) is matched
+
+
+def test_match_headers(matcher):
+    assert matcher.match_headers(['Someone <someone@mail.example.com>', None])
+    assert matcher.match_headers(['a@elsewhere.com, b@sub.wild.net'])
+    assert not matcher.match_headers(['example.com@elsewhere.com', 'no address'])
@@ -0,0 +1,82 @@
+import os
+import time
+import threading
+
+import pytest
+
+from email_archive.durable import GroupCommitter, TMP_SUFFIX
+
+
+class CountingCommitter(GroupCommitter):
+
+    def __init__(self, **kwargs):
+        super(CountingCommitter, self).__init__(**kwargs)
+        self.batches = []
+
+    def flush(self, batch):
+        self.batches.append(len(batch))
+        super(CountingCommitter, self).flush(batch)
+
+
+def test_atomic_write(tmp_path):
+    path = str(tmp_path / 'message.eml')
+    with GroupCommitter().atomic_write(path) as fd:
+        fd.write(b'new')
+    with open(path, 'rb') as fd:
+        assert fd.read() == b'new'
+    assert os.listdir(str(tmp_path)) == ['message.eml']
+
+
+def test_atomic_write_failure_keeps_original(tmp_path):
+    path = str(tmp_path / 'message.eml')
+    with open(path, 'wb') as fd:
+        fd.write(b'original')
+    committer = GroupCommitter()
+    with pytest.raises(RuntimeError):
+        with committer.atomic_write(path) as fd:
+            fd.write(b'partial')
+            raise RuntimeError('Interrupted')
+    with open(path, 'rb') as fd:
+        assert fd.read() == b'original'
+    assert not [x for x in os.listdir(str(tmp_path)) if x.endswith(TMP_SUFFIX)]
+    assert committer.active == 0
+
+
+def test_rename_error_is_raised_to_its_writer(tmp_path):
+    with pytest.raises(OSError):
+        with GroupCommitter().atomic_write(str(tmp_path / 'missing' / 'message.eml')) as fd:
+            fd.write(b'x')
+
+
+def test_lone_writer_does_not_wait(tmp_path):
+    committer = CountingCommitter(window=10)
+    started = time.monotonic()
+    with committer.atomic_write(str(tmp_path / 'message.eml')) as fd:
+        fd.write(b'x')
+    assert time.monotonic() - started < 5
+    assert committer.batches == [1]
+
+
+def test_concurrent_writers_are_flushed_together(tmp_path):
+    committer = CountingCommitter(window=10)
+    writers = 4
+    barrier = threading.Barrier(writers)
+    errors = []
+
+    def write(number):
+        try:
+            with committer.atomic_write(str(tmp_path / '{}.eml'.format(number))) as fd:
+                fd.write(b'x')
+                # Everyone is writing before anyone commits, so the first to commit waits for the others
+                barrier.wait()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(x,)) for x in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not errors
+    assert committer.batches == [writers]
+    assert sorted(os.listdir(str(tmp_path))) == ['{}.eml'.format(x) for x in range(writers)]
@@ -0,0 +1,297 @@
+import fakeredis
+import pytest
+
+from email_archive import fifo
+
+
+@pytest.fixture
+def redis_config(configure):
+    config = {'url': 'redis://', 'queue': 'q'}
+    configure(REDIS=config, ELASTIC={'hosts': ['localhost']})
+    return config
+
+
+@pytest.fixture
+def connection():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def open_queue(redis_config, connection):
+    """Open a queue as the daemons do, after updating the redis configuration with `config`"""
+    def open_queue(consumer=None, size_class=None, **config):
+        redis_config.update(config)
+        return fifo.open_queue(connection, consumer=consumer, size_class=size_class)
+    return open_queue
+
+
+class Clock(object):
+    """Stands in for the time module of fifo"""
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fifo, 'time', clock)
+    return clock
+
+
+def push(queue, items, priority=2):
+    for item in items:
+        queue.push(item, priority=priority)
+
+
+def test_pop_many_in_priority_order(open_queue):
+    queue = open_queue()
+    push(queue, ['a1', 'a2'], priority=3)
+    push(queue, ['b1', 'b2'], priority=1)
+    push(queue, ['c1'], priority=2)
+    assert queue.pop_many(4) == [b'b1', b'b2', b'c1', b'a1']
+    assert queue.pop_many(4) == [b'a2']
+    assert queue.pop_many(4) == []
+
+
+def test_pop_many_blocks_for_one_item(open_queue):
+    queue = open_queue()
+    assert queue.pop_many(10, timeout=1) == []
+    push(queue, ['a'])
+    assert queue.pop_many(10, timeout=1) == [b'a']
+
+
+def test_mark_done_many(open_queue):
+    queue = open_queue()
+    queue.push_tracked('a')
+    queue.push('b')
+    lags = queue.mark_done_many([b'a', b'b'])
+    assert lags[0] >= 0 and lags[1] is None
+    assert queue.mark_done_many([b'a']) == [None]
+
+
+def test_lease_timeout_covers_bulk_requests(open_queue, redis_config, configure):
+    assert open_queue(consumer='c1', reliable=True, lease_timeout=300).lease_timeout == 300
+    assert open_queue(consumer='c1', lease_timeout=10).lease_timeout == 80
+    configure(ELASTIC={'hosts': ['localhost'], 'timeout': 60, 'max_retries': 0})
+    assert open_queue(consumer='c1', lease_timeout=10).lease_timeout == 120
+    # Producers hold no leases
+    assert open_queue(lease_timeout=10).lease_timeout == fifo.LEASE_TIMEOUT
+
+
+def test_reliable_pop_and_ack(open_queue, connection):
+    queue = open_queue(consumer='c1', reliable=True)
+    push(queue, ['a', 'b'])
+    items = queue.pop_many(10)
+    assert items == [b'a', b'b']
+    assert connection.lrange('q:processing:c1', 0, -1) == [b'b', b'a']
+    assert connection.hgetall('q:origin:c1') == {b'a': b'q:2', b'b': b'q:2'}
+    queue.ack(items)
+    assert not connection.exists('q:processing:c1', 'q:leases:c1', 'q:origin:c1')
+
+
+def test_expired_leases_are_requeued_to_their_origin(open_queue, connection, clock):
+    queue = open_queue(consumer='c1', reliable=True, lease_timeout=300, size_classes={'large': 1000})
+    large = open_queue(consumer='c2', size_class='large')
+    queue.push('a', priority=3)
+    queue.push('b', priority=1)
+    queue.push('big', size=5000)
+    assert queue.pop_many(10) == [b'b', b'a']
+    assert large.pop_many(10) == [b'big']
+
+    clock.now += 200
+    queue.ack([b'b'])
+    assert queue.requeue_expired() == 0
+    clock.now += 200
+    assert queue.requeue_expired() == 2
+    assert connection.lrange('q:3', 0, -1) == [b'a']
+    assert connection.lrange('q:2:large', 0, -1) == [b'big']
+    assert connection.llen('q:1') == 0
+    # Consumers without leases left are forgotten
+    assert connection.smembers('q:consumers') == set()
+    assert not connection.exists('q:processing:c1', 'q:origin:c1', 'q:processing:c2', 'q:origin:c2')
+
+
+def test_renewed_leases_are_not_requeued(open_queue, connection, clock):
+    queue = open_queue(consumer='c1', reliable=True, lease_timeout=300)
+    push(queue, ['a', 'b'])
+    items = queue.pop_many(10)
+    clock.now += 250
+    queue.renew(items[:1])
+    clock.now += 100
+    assert queue.requeue_expired() == 1
+    assert connection.lrange('q:2', 0, -1) == [b'b']
+    assert connection.lrange('q:processing:c1', 0, -1) == [b'a']
+
+
+def test_requeue_leaves_items_from_unlisted_queues(open_queue, connection, clock):
+    queue = open_queue(consumer='c1', reliable=True, lease_timeout=300)
+    push(queue, ['a'])
+    queue.pop_many(10)
+    clock.now += 400
+    # Origins read before the item was popped again from another queue
+    assert queue.requeue_expired_command('c1', []) == 0
+    assert connection.zcard('q:leases:c1') == 1
+    assert queue.requeue_expired() == 1
+
+
+def test_scheduler_shares():
+    scheduler = fifo.DeficitScheduler((1, 2, 3), weights={1: 2, '2': 1})
+    assert scheduler.shares == [0.5, 0.25, 0.25]
+    assert scheduler.quotas(4) == [2, 1, 1]
+
+
+def test_scheduler_min_share_raises_weight():
+    scheduler = fifo.DeficitScheduler((1, 2, 3), weights={1: 8}, min_share={2: 0.5, 9: 0.5})
+    assert scheduler.shares[1] == pytest.approx(0.5)
+    # A min_share below the weighted share changes nothing
+    assert fifo.DeficitScheduler((1, 2), min_share={1: 0.1}).shares == [0.5, 0.5]
+    with pytest.raises(fifo.ConfigurationError):
+        fifo.DeficitScheduler((1, 2), min_share={1: 1})
+
+
+def test_scheduler_credit_carries_over_until_drained():
+    scheduler = fifo.DeficitScheduler((1, 2), weights={1: 3, 2: 1})
+    assert scheduler.quotas(2) == [1, 0]
+    scheduler.update([2, 0], [False, False])
+    # Priority 2 keeps its half item of credit while backlogged
+    assert scheduler.quotas(2) == [1, 1]
+    scheduler.update([1, 0], [False, True])
+    assert scheduler.deficits[1] == 0
+
+
+def test_pop_many_shares_batches(open_queue):
+    queue = open_queue(min_share={2: 0.5})
+    push(queue, ['a{}'.format(x) for x in range(10)], priority=1)
+    push(queue, ['b{}'.format(x) for x in range(10)], priority=2)
+    push(queue, ['c{}'.format(x) for x in range(10)], priority=3)
+    # Weights default to 1, raised to 2 for priority 2's half of every batch
+    assert queue.pop_many(4) == [b'a0', b'b0', b'b1', b'c0']
+    assert queue.pop_many(8) == [b'a1', b'a2', b'b2', b'b3', b'b4', b'b5', b'c1', b'c2']
+
+
+def test_pop_many_gives_unused_slots_to_others(open_queue):
+    queue = open_queue(min_share={2: 0.5})
+    push(queue, ['a{}'.format(x) for x in range(10)], priority=1)
+    push(queue, ['b0'], priority=2)
+    assert queue.pop_many(4) == [b'a0', b'b0', b'a1', b'a2']
+    # Priority 2 drained, so it has no credit saved up for when it is backlogged again
+    assert queue.scheduler.deficits[1] == 0
+
+
+def test_pop_many_shares_size_class_lanes(open_queue, connection):
+    queue = open_queue(size_classes={'large': 1000}, weights={1: 1, 2: 1, 3: 1})
+    large = open_queue(size_class='large')
+    for x in range(3):
+        queue.push('big1-{}'.format(x), priority=1, size=5000)
+        queue.push('big3-{}'.format(x), priority=3, size=5000)
+        queue.push('small-{}'.format(x), priority=1)
+    assert large.pop_many(3) == [b'big1-0', b'big3-0', b'big1-1']
+    assert queue.pop_many(2) == [b'small-0', b'small-1']
+
+
+def dead_letters(queue):
+    return [fields for batch in queue.dead_letters.scan() for _, fields in batch]
+
+
+def test_transient_failures_back_off_and_return_to_their_queue(open_queue, connection, clock):
+    queue = open_queue(retry_delay=30, max_retry_delay=100, max_attempts=5)
+    queue.push('a', priority=3)
+    assert queue.pop_many(10) == [b'a']
+
+    expected = [30, 60, 100, 100]
+    for attempt, delay in enumerate(expected, 1):
+        assert queue.fail([('a', 'ConnectionError', 'refused', True)]) == []
+        assert connection.hget('q:attempts', 'a') == str(attempt).encode('ascii')
+        due = connection.zscore('q:retry', 'a')
+        # Jittered between half and all of the delay
+        assert clock.now + delay / 2 <= due <= clock.now + delay
+
+        clock.now = due - 1
+        assert queue.promote_due() == 0
+        clock.now = due
+        assert queue.promote_due() == 1
+        assert connection.lrange('q:3', 0, -1) == [b'a']
+        assert queue.pop_many(10) == [b'a']
+
+    assert queue.fail([('a', 'ConnectionError', 'refused', True)]) == [b'a']
+    assert not connection.exists('q:retry', 'q:attempts', 'q:retry-destination')
+    assert dead_letters(queue) == [{'path': 'a', 'type': 'ConnectionError', 'message': 'refused', 'attempts': '5',
+                                    'size_class': ''}]
+
+
+def test_permanent_failures_are_dead_lettered(open_queue, connection):
+    queue = open_queue(size_classes={'large': 1000})
+    large = open_queue(size_class='large')
+    queue.push('a', size=5000)
+    large.pop_many(10)
+    assert large.fail([('a', 'mapper_parsing_exception', 'x' * 2000, False)]) == [b'a']
+    fields, = dead_letters(queue)
+    assert (fields['attempts'], fields['size_class']) == ('1', 'large')
+    assert len(fields['message']) == fifo.ERROR_MESSAGE_LIMIT
+
+
+def test_clear_attempts(open_queue, connection):
+    queue = open_queue()
+    push(queue, ['a', 'b'])
+    queue.pop_many(10)
+    queue.fail([('a', 'E', '', True), ('b', 'E', '', True)])
+    queue.clear_attempts([b'a'])
+    assert connection.hkeys('q:attempts') == [b'b']
+
+
+@pytest.fixture
+def dead(open_queue, connection):
+    """A queue with dead letters from 1000, 2000 and 3000 seconds past the epoch"""
+    queue = open_queue(size_classes={'large': 1000})
+    for seconds, path, error_type, size_class in [(1000, '2023/05/01/a', 'mapper_parsing_exception', ''),
+                                                 (2000, '2023/05/02/b', 'ConnectionError', 'large'),
+                                                 (3000, '2023/06/01/c', 'mapper_parsing_exception', '')]:
+        connection.xadd('q:dead-letters', {'path': path, 'type': error_type, 'message': '', 'attempts': 1,
+                                           'size_class': size_class}, id='{}-0'.format(seconds * 1000))
+    return queue.dead_letters
+
+
+@pytest.mark.parametrize('filters, paths', [
+    ({}, ['2023/05/01/a', '2023/05/02/b', '2023/06/01/c']),
+    ({'error_type': 'mapper_parsing_exception'}, ['2023/05/01/a', '2023/06/01/c']),
+    ({'since': 2000}, ['2023/05/02/b', '2023/06/01/c']),
+    ({'path_prefix': '2023/05'}, ['2023/05/01/a', '2023/05/02/b']),
+    ({'since': 1500, 'path_prefix': '2023/05', 'error_type': 'ConnectionError'}, ['2023/05/02/b']),
+    ({'path_prefix': '2024'}, []),
+])
+def test_scan_filters(dead, filters, paths):
+    scanned = [[fields['path'] for _, fields in batch] for batch in dead.scan(batch_size=1, **filters)]
+    # Batches without a match are skipped
+    assert all(scanned)
+    assert sum(scanned, []) == paths
+
+
+def test_retry(dead, connection):
+    assert dead.retry(priority=1, error_type='ConnectionError') == 1
+    assert connection.lrange('q:1:large', 0, -1) == [b'2023/05/02/b']
+    assert dead.retry(since=2500, priority=2) == 1
+    assert connection.lrange('q:2', 0, -1) == [b'2023/06/01/c']
+    assert [fields['path'] for batch in dead.scan() for _, fields in batch] == ['2023/05/01/a']
+
+
+@pytest.mark.parametrize('filters, purged, left', [
+    ({}, 3, 0),
+    ({'since': 2000}, 2, 1),
+    ({'path_prefix': '2023/05/0'}, 2, 1),
+    ({'error_type': 'mapper_parsing_exception', 'since': 2000}, 1, 2),
+])
+def test_purge(dead, filters, purged, left):
+    assert dead.purge(**filters) == purged
+    assert dead.length() == left
+
+
+def test_migrate_legacy_failed_list(dead, connection):
+    connection.lpush('q:failed', 'old1', 'old2')
+    assert dead.length() == 5
+    assert dead.migrate(batch_size=1) == 2
+    assert not connection.exists('q:failed')
+    assert [fields['path'] for batch in dead.scan(since=4000) for _, fields in batch] == ['old1', 'old2']
@@ -0,0 +1,67 @@
+import pytest
+
+from email_archive.html_text import html_to_text
+
+
+@pytest.mark.parametrize('html, text', [
+    ('<p>a</p><script type="text/javascript">var x = "<p>";</script><STYLE>p { color: red }</STYLE>b', 'a b'),
+    ('a<script>never closed <p>b', 'a'),
+])
+def test_script_and_style(html, text):
+    assert html_to_text(html) == text
+
+
+@pytest.mark.parametrize('html, text', [
+    ('a<!-- note -->b', 'a b'),
+    ('a<!-- <p>x</p> -->b', 'a b'),
+    ('a<!-- never closed', 'a'),
+])
+def test_comments(html, text):
+    assert html_to_text(html) == text
+
+
+@pytest.mark.parametrize('html, text', [
+    ('x <a href="y', 'x'),
+    ('a <3 <br', 'a <3'),
+    ('a<b', 'a'),
+])
+def test_unterminated_tags(html, text):
+    assert html_to_text(html) == text
+
+
+@pytest.mark.parametrize('html, text', [
+    ('<a title="x>y" b=\'>\' c=d>t</a>u', 'tu'),
+    ('<img alt="a > b">c', 'c'),
+    ('<b"q>z', 'z'),
+])
+def test_quoted_attributes(html, text):
+    assert html_to_text(html) == text
+
+
+@pytest.mark.parametrize('html, text', [
+    ('fish &amp; chips &lt;b&gt; &#39;q&#x27;', "fish & chips <b> 'q'"),
+    ('&amp fish &copy2', '& fish ©2'),
+    ('a&nbsp;b', 'a b'),
+])
+def test_entities(html, text):
+    assert html_to_text(html) == text
+
+
+@pytest.mark.parametrize('html, text', [
+    ('<![CDATA[x]]>y', 'y'),
+    ('<!DOCTYPE html><?xml version="1.0"?>z', 'z'),
+])
+def test_declarations(html, text):
+    assert html_to_text(html) == text
+
+
+@pytest.mark.parametrize('html, text', [
+    ('wo<b>r</b>d', 'word'),
+    ('<div>a</div><span>b</span>c', 'a bc'),
+    ('a<BR/>b', 'a b'),
+    ('<td class=x>a</td><td>b', 'a b'),
+    ('<p>a</p>\n\n<p>\tb  </p>', 'a b'),
+    ('', ''),
+])
+def test_whitespace(html, text):
+    assert html_to_text(html) == text
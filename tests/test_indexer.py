@@ -0,0 +1,54 @@
+from email.message import EmailMessage
+
+import pytest
+
+from email_archive.indexer import Indexer
+
+
+@pytest.fixture
+def indexer(configure):
+    configure(INDEXER={})
+    return Indexer()
+
+
+def make_message():
+    message = EmailMessage()
+    message['Message-Id'] = '<1@example.com>'
+    message['Date'] = 'Tue, 05 May 2020 12:00:00 +0000'
+    message['From'] = 'a@example.com'
+    message['To'] = 'b@example.com'
+    message['Subject'] = 'Test'
+    return message
+
+
+def test_headerless_attachment_after_body(indexer):
+    message = make_message()
+    message.set_content('The body')
+    message.add_attachment(b'%PDF', maintype='application', subtype='pdf', filename='a.pdf')
+    part = EmailMessage()
+    part.set_payload('\x00\x01 binary')
+    message.attach(part)
+    source = indexer.prepare_message('2020/05/05/1200/a.eml.gz', message)['_source']
+    assert source['body'] == 'The body\n'
+    assert source['attachments'] == [('a.pdf', 'application/pdf')]
+
+
+def test_mixed_case_html_body(indexer):
+    message = make_message()
+    message.set_content('<p>Rich &amp; <b>bold</b></p>', subtype='html')
+    message.replace_header('Content-Type', 'Text/HTML; charset="utf-8"')
+    source = indexer.prepare_message('2020/05/05/1200/a.eml.gz', message)['_source']
+    assert source['body'] == 'Rich & bold'
+    assert indexer.body_selection == {'prefer_html:html': 1}
+
+
+@pytest.mark.parametrize('config, body', [
+    ({}, 'Rich'),
+    ({'body_policy': 'auto', 'plain_min_length': 10}, 'A plain alternative\n'),
+])
+def test_body_policy_defaults_to_html(configure, config, body):
+    configure(INDEXER=config)
+    message = make_message()
+    message.set_content('A plain alternative')
+    message.add_alternative('<p>Rich</p>', subtype='html')
+    assert Indexer().prepare_message('2020/05/05/1200/a.eml.gz', message)['_source']['body'] == body
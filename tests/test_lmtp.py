@@ -0,0 +1,58 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from email_archive.lmtp import LMTPSession
+
+
+class FakeServer(object):
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.messages = []
+
+    def archive(self, data):
+        try:
+            data.seek(0)
+            self.messages.append(data.read())
+        finally:
+            data.close()
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.written = b''
+
+    def write(self, data):
+        self.written += data
+
+    async def drain(self):
+        pass
+
+
+def converse(lines, limit=64):
+    async def main():
+        reader = asyncio.StreamReader(limit=limit)
+        reader.feed_data(b''.join(lines))
+        reader.feed_eof()
+        server, writer = FakeServer(), FakeWriter()
+        await LMTPSession(server, reader, writer).run()
+        return server.messages, writer.written.decode('ascii').splitlines()
+    return asyncio.run(main())
+
+
+ENVELOPE = [b'LHLO client\r\n', b'MAIL FROM:<a@example.com>\r\n', b'RCPT TO:<b@example.com>\r\n',
+            b'RCPT TO:<c@example.com>\r\n', b'DATA\r\n']
+
+
+def test_delivery():
+    messages, replies = converse(ENVELOPE + [b'Subject: x\r\n', b'\r\n', b'..dot\r\n', b'.\r\n', b'QUIT\r\n'])
+    assert messages == [b'Subject: x\r\n\r\n.dot\r\n']
+    assert replies[-3:] == ['250 2.0.0 Ok', '250 2.0.0 Ok', '221 2.0.0 Bye']
+
+
+def test_data_line_too_long():
+    messages, replies = converse(ENVELOPE + [b'Subject: x\r\n', b'x' * 200 + b'\r\n', b'more\r\n', b'.\r\n',
+                                             b'NOOP\r\n', b'QUIT\r\n'])
+    assert messages == []
+    assert replies[-4:] == ['552 5.3.4 Line too long', '552 5.3.4 Line too long', '250 2.0.0 Ok', '221 2.0.0 Bye']
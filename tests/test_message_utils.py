@@ -0,0 +1,62 @@
+from email.message import EmailMessage
+
+from email_archive.message_utils import analyze, payload_size
+
+
+def alternative_message(text, html, text_encoding=None, html_encoding=None):
+    message = EmailMessage()
+    message.set_content(text, cte=text_encoding)
+    message.add_alternative(html, subtype='html', cte=html_encoding)
+    return message
+
+
+def test_payload_size_is_decoded():
+    message = alternative_message('x' * 900, '<p>{}</p>'.format('y' * 8000 + '=' * 100), text_encoding='base64',
+                                  html_encoding='quoted-printable')
+    for part in message.get_payload():
+        assert abs(payload_size(part) - len(part.get_content())) <= 4
+
+
+def test_auto_policy_compares_decoded_sizes():
+    # 1220 characters once base64 encoded, but only 901 decoded
+    message = alternative_message('x' * 900, '<p>{}</p>'.format('y' * 8000), text_encoding='base64')
+    summary = analyze(message, 'auto', min_length=1000, min_ratio=0.2)
+    assert summary.body.get_content_type() == 'text/html'
+    assert summary.skipped_html is None
+
+    summary = analyze(message, 'auto', min_length=900, min_ratio=0.2)
+    assert summary.body.get_content_type() == 'text/plain'
+    assert summary.skipped_html.get_content_type() == 'text/html'
+
+
+def headerless_part(payload):
+    part = EmailMessage()
+    part.set_payload(payload)
+    return part
+
+
+def test_headerless_part_is_not_the_body():
+    message = EmailMessage()
+    message.set_content('The body')
+    message.add_attachment(b'%PDF', maintype='application', subtype='pdf', filename='a.pdf')
+    message.attach(headerless_part('\x00\x01 binary'))
+    summary = analyze(message)
+    assert summary.body.get_content() == 'The body\n'
+    assert summary.body_type == 'text/plain'
+    assert summary.attachment_details == [('a.pdf', 'application/pdf')]
+
+
+def test_content_type_case():
+    message = alternative_message('Plain', '<p>Rich</p>')
+    message.get_payload()[1].replace_header('Content-Type', 'Text/HTML; charset="utf-8"')
+    summary = analyze(message)
+    assert summary.body is message.get_payload()[1]
+    assert summary.body_type == 'text/html'
+
+
+def test_non_multipart_body_type():
+    message = EmailMessage()
+    message.set_payload('Plain')
+    assert analyze(message).body_type is None
+    message['Content-Type'] = 'TEXT/plain'
+    assert analyze(message).body_type == 'text/plain'
@@ -0,0 +1,71 @@
+import pytest
+
+from email_archive import segments
+from email_archive.durable import GroupCommitter
+
+
+MESSAGES = [b'Message-ID: <%d@example.com>\r\n\r\nBody %d\r\n' % (x, x) * (x + 1) for x in range(5)]
+
+
+@pytest.fixture(params=['gzip', 'zstd', 'none'])
+def segment(request, configure, tmp_path):
+    configure(STORAGE={'codec': request.param}, ARCHIVE_DIR=str(tmp_path))
+    path = str(tmp_path / ('1200' + segments.SEGMENT_SUFFIX))
+    offsets = [segments.append(path, [x[:10], x[10:]], key=str(n))[0] for n, x in enumerate(MESSAGES)]
+    return path, offsets
+
+
+def test_read_every_member(segment):
+    path, offsets = segment
+    for offset, message in zip(offsets, MESSAGES):
+        assert segments.read_member(path, offset) == message
+        with segments.open_ref(segments.make_ref(path, offset)) as fd:
+            assert fd.read() == message
+
+
+def test_iter_index(segment):
+    path, offsets = segment
+    members = list(segments.iter_index(path))
+    assert [x[0] for x in members] == offsets
+    assert [x[2] for x in members] == [str(x) for x in range(len(MESSAGES))]
+    # Members are contiguous and cover the whole segment
+    assert all(offset + length == following for (offset, length, _), following in zip(members, offsets[1:]))
+    with open(path, 'rb') as fd:
+        assert sum(x[1] for x in members) == len(fd.read())
+
+
+def test_iter_index_skips_torn_line(segment):
+    path, offsets = segment
+    with open(segments.index_path(path), 'a') as idx:
+        idx.write('12345 67')
+    assert [x[0] for x in segments.iter_index(path)] == offsets
+
+
+def test_parse_ref():
+    assert segments.parse_ref('2020/05/05/1200.seg:42') == ('2020/05/05/1200.seg', 42)
+    assert segments.parse_ref('2020/05/05/1200/1200-ab.eml.gz') is None
+    assert segments.parse_ref('2020/05/05/1200.seg:x') is None
+
+
+def test_append_with_committer(configure, tmp_path):
+    configure(STORAGE={'codec': 'gzip'}, ARCHIVE_DIR=str(tmp_path))
+    committer = GroupCommitter(window=0)
+    path = str(tmp_path / ('1200' + segments.SEGMENT_SUFFIX))
+    offset, _ = segments.append(path, [MESSAGES[0]], committer=committer)
+    assert (offset, committer.active) == (0, 0)
+    assert segments.read_member(path, offset) == MESSAGES[0]
+
+
+def test_append_abandons_commit_on_error(configure, tmp_path):
+    configure(STORAGE={'codec': 'gzip'}, ARCHIVE_DIR=str(tmp_path))
+    committer = GroupCommitter(window=0)
+
+    def chunks():
+        yield MESSAGES[0]
+        raise IOError('Client went away')
+
+    path = str(tmp_path / ('1200' + segments.SEGMENT_SUFFIX))
+    with pytest.raises(IOError):
+        segments.append(path, chunks(), committer=committer)
+    assert committer.active == 0
+    assert not (tmp_path / ('1200' + segments.SEGMENT_SUFFIX)).exists()